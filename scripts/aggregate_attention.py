@@ -0,0 +1,161 @@
+import os
+import re
+import json
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from tqdm import tqdm
+from input_store import load_inputs, INPUT_NAMES
+from format_data import format_timestep, ATTENTION_DTYPES
+from attention_variants import variant_layer_name
+
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}$')
+AGGREGATE_NAME = 'aggregate.json'
+STATISTICS = ['mean', 'variance']
+
+def find_timesteps(output_data_dir, start_date, end_date, layer_names, data_times=None):
+    """Timesteps between start_date and end_date, inclusive, that have every layer, as sorted (date, time) pairs."""
+    timesteps = []
+    for data_date in sorted(os.listdir(output_data_dir)):
+        if not DATE_PATTERN.match(data_date) or not start_date <= data_date <= end_date:
+            continue
+        for data_time in sorted(os.listdir(os.path.join(output_data_dir, data_date))):
+            time_path = os.path.join(output_data_dir, data_date, data_time)
+            if data_times and data_time not in data_times:
+                continue
+            if all(os.path.exists(os.path.join(time_path, f"{name}.npy")) for name in layer_names):
+                timesteps.append((data_date, data_time))
+    return timesteps
+
+def anomaly_name(data_date, data_time):
+    """Time directory of the anomaly of a timestep against an aggregate."""
+    return f"anomaly_{data_date}_{data_time}"
+
+def load_array(data_dirs, data_date, data_time, name):
+    """Memory-map one input or attention layer of a timestep, without reading it."""
+    input_data_dir, output_data_dir = data_dirs
+    if name in INPUT_NAMES:
+        return load_inputs(input_data_dir, data_date, data_time, mmap_mode='r')[INPUT_NAMES.index(name)]
+    return np.load(os.path.join(output_data_dir, data_date, data_time, f"{name}.npy"), mmap_mode='r')
+
+def target_path(data_dirs, label, time_name, name):
+    """Path of an aggregated array, in the input or output data layout the formatter reads."""
+    input_data_dir, output_data_dir = data_dirs
+    base_dir = input_data_dir if name in INPUT_NAMES else output_data_dir
+    return os.path.join(base_dir, label, time_name, f"{name}.npy")
+
+def aggregate_block(data_dirs, name, block, timesteps, targets, anomalies):
+    """Accumulate the mean and variance of one block of an array over every timestep with Welford's algorithm.
+
+    The block is a slice of the leading axis, the lon windows of an attention layer or the variables of an input,
+    so a worker only holds the running statistics of one block in float64. The results, and the anomaly of
+    each timestep in anomalies against the mean, are written into the memory-mapped target files.
+    """
+    mean = m2 = None
+    for count, (data_date, data_time) in enumerate(timesteps, start=1):
+        values = np.asarray(load_array(data_dirs, data_date, data_time, name)[block], dtype=np.float64)
+        if mean is None:
+            mean, m2 = np.zeros_like(values), np.zeros_like(values)
+        delta = values - mean
+        mean += delta / count
+        m2 += delta * (values - mean)
+
+    results = {'mean': mean, 'variance': m2 / len(timesteps)}
+    for data_date, data_time in anomalies:
+        values = load_array(data_dirs, data_date, data_time, name)[block]
+        results[anomaly_name(data_date, data_time)] = values - mean
+    for time_name, result in results.items():
+        target = np.load(targets[time_name], mmap_mode='r+')
+        target[block] = result
+        target.flush()
+    return name, block
+
+def plan_blocks(length, block_size):
+    """Split a leading axis into slices of at most block_size."""
+    return [slice(start, min(start + block_size, length)) for start in range(0, length, block_size)]
+
+def aggregate(timesteps, intermediate_layers, label, input_data_dir='input_data', output_data_dir='output_data', anomalies=(),
+              block_size=1, max_workers=None, models_dir='checkpoints', model_num=None):
+    """Write the mean and variance over timesteps of the inputs and attention layers, and the anomalies of some
+    timesteps against the mean, as the timesteps 'mean', 'variance' and anomaly_{date}_{time} of the date label.
+
+    Every target is created up front as a temporary .npy file that the workers fill block by block, and renamed
+    once complete. The layers are named after the graph index of the model in models_dir. Returns the names of the
+    timesteps written.
+    """
+    data_dirs = (input_data_dir, output_data_dir)
+    names = INPUT_NAMES + [variant_layer_name('post_bias', layer_index, models_dir, model_num).replace('/', '_')
+                           for layer_index in intermediate_layers]
+    time_names = STATISTICS + [anomaly_name(*timestep) for timestep in anomalies]
+
+    tasks, targets = [], {}
+    for name in names:
+        sample = load_array(data_dirs, *timesteps[0], name)
+        targets[name] = {}
+        for time_name in time_names:
+            path = target_path(data_dirs, label, time_name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            np.lib.format.open_memmap(f"{path}.tmp", mode='w+', dtype=np.float32, shape=sample.shape).flush()
+            targets[name][time_name] = f"{path}.tmp"
+        tasks.extend((name, block) for block in plan_blocks(sample.shape[0], block_size))
+
+    with ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(aggregate_block, data_dirs, name, block, timesteps, targets[name], anomalies) for name, block in tasks]
+        for future in tqdm(as_completed(futures), total=len(futures), desc=f"Aggregating {len(timesteps)} timesteps"):
+            future.result()
+
+    for name in names:
+        for time_name, tmp_path in targets[name].items():
+            os.replace(tmp_path, tmp_path[:-len('.tmp')])
+    with open(os.path.join(output_data_dir, label, AGGREGATE_NAME), 'w') as aggregate_file:
+        json.dump({'timesteps': [' '.join(timestep) for timestep in timesteps], 'layers': names[len(INPUT_NAMES):],
+                   'statistics': time_names}, aggregate_file, indent=4)
+    return time_names
+
+def main(args):
+    layer_names = [variant_layer_name('post_bias', layer_index, args.models_dir, args.model_num).replace('/', '_')
+                   for layer_index in args.intermediate_layers]
+    timesteps = find_timesteps(args.output_data_dir, args.start_date, args.end_date, layer_names, args.data_times)
+    if not timesteps:
+        print(f"No timesteps with layers {layer_names} between {args.start_date} and {args.end_date} in {args.output_data_dir}")
+        return
+    anomalies = [tuple(anomaly.split(' ')) for anomaly in args.anomalies]
+    missing = [anomaly for anomaly in anomalies if not all(
+        os.path.exists(os.path.join(args.output_data_dir, *anomaly, f"{name}.npy")) for name in layer_names)]
+    if missing:
+        raise ValueError(f"Anomaly timesteps without every layer: {missing}")
+
+    label = args.label or f"{args.start_date}_to_{args.end_date}"
+    time_names = aggregate(timesteps, args.intermediate_layers, label, input_data_dir=args.input_data_dir,
+                           output_data_dir=args.output_data_dir, anomalies=anomalies, block_size=args.block_size,
+                           max_workers=args.max_workers, models_dir=args.models_dir, model_num=args.model_num)
+    print(f"Aggregated {len(timesteps)} timesteps into {os.path.join(args.output_data_dir, label)}")
+
+    if args.src_dir is not None:
+        for time_name in time_names:
+            # Only the mean is a set of attention scores, so the variance and anomalies get no softmax statistics.
+            format_timestep(args.src_dir, args.input_data_dir, args.output_data_dir, label, time_name, args.intermediate_layers,
+                            attention_dtype=args.attention_dtype, models_dir=args.models_dir, model_num=args.model_num,
+                            stats=time_name == 'mean', verbose=args.verbose)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Aggregate the inputs and attention of many timesteps into a mean, variance and anomalies that the web app shows as a date.')
+    parser.add_argument('--start_date', type=str, required=True, help='First date to aggregate, in YYYY-MM-DD format.')
+    parser.add_argument('--end_date', type=str, required=True, help='Last date to aggregate, in YYYY-MM-DD format.')
+    parser.add_argument('--data_times', type=str, nargs='+', help='Only aggregate these times, in HH:MM format.')
+    parser.add_argument('--intermediate_layers', type=int, nargs='+', required=True, help='Indices of intermediate layers to aggregate.')
+    parser.add_argument('--anomalies', type=str, nargs='+', default=[], help='Timesteps, as "YYYY-MM-DD HH:MM", to compare against the mean.')
+    parser.add_argument('--label', type=str, help='Date directory of the aggregate, by default {start_date}_to_{end_date}.')
+    parser.add_argument('--input_data_dir', type=str, default='input_data', help='Directory for input data.')
+    parser.add_argument('--output_data_dir', type=str, default='output_data', help='Directory for output data.')
+    parser.add_argument('--src_dir', type=str, help='Format the aggregate into the web app in this directory.')
+    parser.add_argument('--attention_dtype', choices=ATTENTION_DTYPES, default='float32', help='Storage type of the formatted attention.')
+    parser.add_argument('--models_dir', type=str, default='checkpoints', help='Directory of the model, read for its layer names and for the shift masks of shifted layers when formatting.')
+    parser.add_argument('--model_num', type=int, default=24, help='Model the activations were saved from.')
+    parser.add_argument('--block_size', type=int, default=1, help='Leading-axis slices, lon windows or variables, per task.')
+    parser.add_argument('--max_workers', type=int, help='Number of worker processes, by default one per core.')
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,106 @@
+import os
+import numpy as np
+import onnx
+from onnx import numpy_helper
+from onnx.reference import ReferenceEvaluator
+import model_cache
+from index_graph import attention_layers
+
+def trace_attention(graph, scores, biased, softmax):
+    """Find the constant tensors between the scores and the softmax of one attention layer.
+
+    Returns the name of the positional bias added to the scores and the names of the masks added to the biased
+    scores before the softmax. Raises ValueError if the layer is not a chain of Add nodes from scores to softmax.
+    """
+    producers = {output: node for node in graph.node for output in node.output}
+    bias_node = producers.get(biased)
+    if bias_node is None or bias_node.op_type != 'Add' or scores not in bias_node.input:
+        raise ValueError(f"{biased} is not the sum of {scores} and a bias.")
+    bias = next(name for name in bias_node.input if name != scores)
+
+    def depends_on(tensor, target, seen=None):
+        seen = set() if seen is None else seen
+        if tensor == target:
+            return True
+        if tensor in seen or tensor not in producers:
+            return False
+        seen.add(tensor)
+        return any(depends_on(name, target, seen) for name in producers[tensor].input)
+
+    masks = []
+    softmax_node = producers.get(softmax)
+    if softmax_node is None or softmax_node.op_type != 'Softmax':
+        raise ValueError(f"{softmax} is not a softmax output.")
+    tensor = softmax_node.input[0]
+    while tensor != biased:
+        node = producers.get(tensor)
+        if node is None or node.op_type != 'Add':
+            raise ValueError(f"Only Add nodes are supported between {biased} and the softmax, found {node.op_type if node else tensor}.")
+        tensor, mask = node.input if depends_on(node.input[0], biased) else node.input[::-1]
+        masks.append(mask)
+    return bias, masks[::-1]
+
+def evaluate_constant(model, name):
+    """Evaluate a tensor of the model that does not depend on the model inputs."""
+    graph = model.graph
+    initializers = {initializer.name: initializer for initializer in graph.initializer}
+    if name in initializers:
+        return numpy_helper.to_array(initializers[name])
+    producers = {output: node for node in graph.node for output in node.output}
+    input_names = {graph_input.name for graph_input in graph.input}
+    nodes, used, pending = [], set(), [name]
+    while pending:
+        tensor = pending.pop()
+        if tensor in input_names:
+            raise ValueError(f"{name} depends on the model input {tensor}.")
+        if tensor in used or tensor in initializers or not tensor:
+            continue
+        used.add(tensor)
+        node = producers[tensor]
+        nodes.append(node)
+        pending.extend(node.input)
+    nodes = [node for node in graph.node if node in nodes]
+    used_initializers = [initializers[tensor] for tensor in {tensor for node in nodes for tensor in node.input} if tensor in initializers]
+    subgraph = onnx.helper.make_graph(nodes, 'constant', [], [onnx.helper.make_empty_tensor_value_info(name)], used_initializers)
+    return ReferenceEvaluator(onnx.helper.make_model(subgraph, opset_imports=model.opset_import)).run(None, {})[0]
+
+def constants_path(models_dir, model_num, model_hash, layer_index):
+    """Cache path of the positional bias and masks of one layer of a model."""
+    return os.path.join(models_dir, model_cache.CACHE_DIR_NAME, f'pangu_weather_{model_num}_{model_hash[:16]}_attention_{layer_index}.npz')
+
+def load_attention_constants(models_dir, model_num, layer_index):
+    """Return the positional bias and the sum of the masks of one attention layer, extracted once per model.
+
+    Raises FileNotFoundError if the model is not in models_dir.
+    """
+    model_path = os.path.join(models_dir, f'pangu_weather_{model_num}.onnx')
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Attention layer {layer_index} needs the positional bias or shift mask of {model_path}, "
+                                f"which does not exist. Set --models_dir and --model_num to the model the activations came from.")
+    path = constants_path(models_dir, model_num, model_cache.hash_model(model_path), layer_index)
+    if not os.path.exists(path):
+        model = onnx.load(model_path)
+        layer = attention_layers(models_dir, model_num)[layer_index]
+        bias, masks = ((layer['bias'], layer['masks']) if 'bias' in layer else
+                       trace_attention(model.graph, layer['pre_bias'], layer['post_bias'], layer['post_softmax']))
+        mask = sum((evaluate_constant(model, name) for name in masks), np.zeros((), dtype=np.float32))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(f"{path}.tmp.npz", bias=evaluate_constant(model, bias), mask=mask)
+        os.replace(f"{path}.tmp.npz", path)
+    with np.load(path) as constants:
+        return constants['bias'], constants['mask']
+
+def shift_mask(models_dir, model_num, layer_index):
+    """Return the shift mask added to the scores of a shifted attention layer, or None for other layers.
+
+    Only shifted layers read the model.
+    """
+    if not attention_layers(models_dir, model_num)[layer_index]['shifted']:
+        return None
+    return load_attention_constants(models_dir, model_num, layer_index)[1]
+
+def constant_window(constant, lon):
+    """The lon window of a constant broadcast against a (lon, lat_pl, head, query, key) layer."""
+    constant = np.asarray(constant, dtype=np.float32)
+    constant = constant.reshape((1,) * (5 - constant.ndim) + constant.shape)
+    return constant[lon if constant.shape[0] > 1 else 0]
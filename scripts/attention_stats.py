@@ -0,0 +1,89 @@
+import os
+import json
+import numpy as np
+import argparse
+from format_data import ATTENTION_METRICS, ATTENTION_STATS_INDEX_NAME, AVAILABLE_DATA_NAME
+from attention_variants import ATTENTION_VARIANTS, variant_layer_name
+
+def load_stats(layer_dir):
+    """Load the (lon, lat_pl, head, metric) statistics of a formatted layer and their metric names, or None."""
+    index_path = os.path.join(layer_dir, ATTENTION_STATS_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as index_file:
+        index = json.load(index_file)
+    stats = np.fromfile(os.path.join(layer_dir, index['file']), dtype=index['dtype']).reshape(index['shape'])
+    return stats, index['metrics']
+
+def find_layers(src_dir, data_date=None, data_time=None, layers=None):
+    """List the (date, time, layer) entries of available_data.json, optionally filtered by date, time and layer names."""
+    with open(os.path.join(src_dir, AVAILABLE_DATA_NAME)) as available_data_file:
+        available_data = json.load(available_data_file)
+    return [(date, time, name) for date, times in sorted(available_data.items()) if data_date in (None, date)
+            for time, names in sorted(times.items()) if data_time in (None, time)
+            for name in names if layers is None or name in layers]
+
+def rank_slices(stats, metric_index, by='slice'):
+    """Reduce the statistics of a layer to one value per ranked slice.
+
+    by 'slice' ranks each window and head, 'window' averages over heads and 'head' averages over windows.
+    Returns the values and the (lon, lat_pl, head) index of every slice, with None for averaged axes.
+    """
+    values = stats[..., metric_index]
+    if by == 'window':
+        values = values.mean(axis=2)
+    elif by == 'head':
+        values = values.mean(axis=(0, 1))
+    indices = np.indices(values.shape).reshape(values.ndim, -1).T
+    axes = {'slice': (0, 1, 2), 'window': (0, 1), 'head': (2,)}[by]
+    slices = [tuple(int(index[axes.index(axis)]) if axis in axes else None for axis in range(3)) for index in indices]
+    return values.ravel(), slices
+
+def top_slices(src_dir, metric, top=10, by='slice', ascending=False, data_date=None, data_time=None, layers=None):
+    """Find the top slices by a metric over every matching formatted layer.
+
+    Returns (value, date, time, layer, lon, lat_pl, head) rows, highest first unless ascending.
+    """
+    rows = []
+    for date, time, name in find_layers(src_dir, data_date, data_time, layers):
+        loaded = load_stats(os.path.join(src_dir, 'bin', date, time, name))
+        if loaded is None:
+            continue
+        stats, metrics = loaded
+        values, slices = rank_slices(stats, metrics.index(metric), by=by)
+        order = np.argsort(values if ascending else -values, kind='stable')[:top]
+        rows.extend((float(values[i]), date, time, name) + slices[i] for i in order)
+    rows.sort(key=lambda row: row[0], reverse=not ascending)
+    return rows[:top]
+
+def main(args):
+    layers = None
+    if args.layer is not None:
+        # A layer index matches the layer in every attention variant.
+        layers = ({variant_layer_name(variant, int(args.layer), args.models_dir, args.model_num).replace('/', '_')
+                   for variant in ATTENTION_VARIANTS} if args.layer.isdigit() else {args.layer})
+    rows = top_slices(args.src_dir, args.metric, top=args.top, by=args.by, ascending=args.ascending,
+                      data_date=args.data_date, data_time=args.data_time, layers=layers)
+    if not rows:
+        print(f"No attention statistics found in {args.src_dir}")
+        return
+    print(f"{args.metric:>14} {'date':>10} {'time':>5} {'layer':>24} {'lon':>4} {'lat_pl':>6} {'head':>4}")
+    for value, date, time, name, lon, lat_pl, head in rows:
+        print(f"{value:14.6f} {date:>10} {time:>5} {name:>24} " +
+              " ".join(f"{'-' if index is None else index:>{width}}" for index, width in ((lon, 4), (lat_pl, 6), (head, 4))))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rank attention windows and heads by their precomputed statistics.')
+    parser.add_argument('--src_dir', type=str, default='src', help='Directory of the web app containing the bin directory.')
+    parser.add_argument('--metric', choices=ATTENTION_METRICS, default='entropy', help='Statistic to rank by.')
+    parser.add_argument('--top', type=int, default=10, help='Number of results to show.')
+    parser.add_argument('--by', choices=['slice', 'window', 'head'], default='slice', help='Rank each window and head, each window averaged over heads or each head averaged over windows.')
+    parser.add_argument('--ascending', action='store_true', help='Show the lowest values first.')
+    parser.add_argument('--data_date', type=str, help='Only search this date, in YYYY-MM-DD format.')
+    parser.add_argument('--data_time', type=str, help='Only search this time, in HH:MM format.')
+    parser.add_argument('--layer', type=str, help='Only search this layer, by index or directory name.')
+    parser.add_argument('--models_dir', type=str, default='checkpoints', help='Directory of the indexed model naming the layers given by index.')
+    parser.add_argument('--model_num', type=int, help='Indexed model to name the layers after, by default any.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,91 @@
+import numpy as np
+from attention_constants import load_attention_constants, shift_mask, constant_window
+from index_graph import attention_layers
+
+# Each attention layer passes through the scores of the query-key MatMul, the sum with the earth-specific
+# positional bias, and the softmax. Shifted windows add a mask to the biased scores before the softmax.
+ATTENTION_VARIANTS = ['pre_bias', 'post_bias', 'post_softmax']
+# The single tensor exported from the model for a variant. The softmax is derived from the biased scores,
+# so the exported activations also serve the post_bias variant.
+EXPORTED_VARIANTS = {'pre_bias': 'pre_bias', 'post_bias': 'post_bias', 'post_softmax': 'post_bias'}
+
+def variant_layer_name(variant, layer_index, models_dir='checkpoints', model_num=None):
+    """Graph tensor name of a layer in an attention variant, from the graph index of the model."""
+    return attention_layers(models_dir, model_num)[layer_index][variant]
+
+def find_layer(name, models_dir='checkpoints', model_num=None):
+    """Return the (variant, layer index) of an attention tensor name, with '/' or '_' separators, or None."""
+    for layer_index, layer in enumerate(attention_layers(models_dir, model_num)):
+        for variant in ATTENTION_VARIANTS:
+            if name in (layer[variant], layer[variant].replace('/', '_')):
+                return variant, layer_index
+    return None
+
+class DerivedAttention:
+    """Read-only view of one attention variant of a layer derived from another, one lon window at a time.
+
+    Indexing with a lon window first, as the formatter does, derives only that window, so memory stays
+    bounded by one window however large the layer. With logits the softmax variant is viewed as the scores
+    it is taken over, including the shift masks. A mask of None is left out, as for unshifted layers.
+    """
+
+    def __init__(self, source, source_variant, variant, bias=None, mask=None, logits=False):
+        if source_variant == 'post_softmax' and variant != 'post_softmax':
+            raise ValueError(f"The {variant} attention cannot be derived from the softmax.")
+        self.source = source
+        self.source_variant = source_variant
+        self.variant = variant
+        self.bias = bias
+        self.mask = mask
+        self.logits = logits
+        self.shape = source.shape
+        self.dtype = np.dtype(np.float32)
+        self._cached = (None, None)
+
+    def _derive(self, lon):
+        block = np.asarray(self.source[lon], dtype=np.float32)
+        if self.source_variant == 'post_softmax':
+            return np.log(np.maximum(block, np.finfo(np.float32).tiny)) if self.logits else block
+        if self.source_variant == 'pre_bias' and self.variant != 'pre_bias':
+            block = block + constant_window(self.bias, lon)
+        elif self.source_variant == 'post_bias' and self.variant == 'pre_bias':
+            block = block - constant_window(self.bias, lon)
+        if self.variant != 'post_softmax':
+            return block
+        if self.mask is not None:
+            block = block + constant_window(self.mask, lon)
+        if self.logits:
+            return block
+        weights = np.exp(block - block.max(axis=-1, keepdims=True))
+        return weights / weights.sum(axis=-1, keepdims=True)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        lon = int(key[0])
+        if self._cached[0] != lon:
+            self._cached = (lon, self._derive(lon))
+        return self._cached[1][key[1:]]
+
+def attention_view(attention_output, source_variant, variant, layer_index, models_dir='checkpoints', model_num=24, logits=False):
+    """View an exported attention layer as another variant, loading the model constants only when needed.
+
+    The model is read for the positional bias when converting to or from pre_bias, and for the shift mask when
+    deriving the softmax of a shifted layer. Other views never open the model.
+    """
+    if source_variant == variant and not (logits and variant == 'post_softmax'):
+        return attention_output
+    needs_bias = source_variant != variant and 'pre_bias' in (source_variant, variant)
+    bias = load_attention_constants(models_dir, model_num, layer_index)[0] if needs_bias else None
+    needs_mask = variant == 'post_softmax' and source_variant != 'post_softmax'
+    mask = shift_mask(models_dir, model_num, layer_index) if needs_mask else None
+    return DerivedAttention(attention_output, source_variant, variant, bias=bias, mask=mask, logits=logits)
+
+def softmax_scores(attention_output, source_variant, layer_index, models_dir='checkpoints', model_num=24):
+    """Return the scores the softmax of an exported layer is taken over and the shift mask to add to them, or None.
+
+    Softmax weights are viewed as their logits, which already include the mask.
+    """
+    if source_variant == 'post_softmax':
+        return attention_view(attention_output, source_variant, source_variant, layer_index, logits=True), None
+    scores = attention_view(attention_output, source_variant, 'post_bias', layer_index, models_dir=models_dir, model_num=model_num)
+    return scores, shift_mask(models_dir, model_num, layer_index)
@@ -0,0 +1,296 @@
+import os
+import io
+import json
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from contextlib import redirect_stdout
+from time import perf_counter
+import numpy as np
+import pandas as pd
+import xarray as xr
+import onnx
+from onnx import helper, numpy_helper, TensorProto
+import download_data
+from download_data import SURFACE_VARS, UPPER_VARS
+from save_activations import prepare_session, create_runner, process_timestep
+from format_data import format_timestep, ATTENTION_DTYPES
+from attention_variants import ATTENTION_VARIANTS
+from index_graph import default_layers
+
+STAGE_NAMES = ['download', 'activations', 'format']
+SYNTHETIC_NAME = 'synthetic.json'
+START_TIME = '2018-01-01T00:00'
+INPUT_SHAPE = (721, 1440)
+NUM_LEVELS = 13
+# Width of the synthetic query and key vectors, small so the model stays a few MB per layer.
+KEY_SIZE = 8
+TOKENS = 144
+
+def timesteps(num_timesteps):
+    """The (date, time) of each synthetic timestep, twice a day like the Pangu data."""
+    times = pd.date_range(START_TIME, periods=num_timesteps, freq='12h')
+    return [(time.strftime('%Y-%m-%d'), time.strftime('%H:%M')) for time in times]
+
+def work_paths(work_dir):
+    """Directories of the store, models, inputs, outputs and web app inside the work directory."""
+    return {name: os.path.join(work_dir, name) for name in ['store.zarr', 'checkpoints', 'input_data', 'output_data', 'src', 'profiles']}
+
+def synthetic_layer_shape(layer, lon_windows):
+    """Shape of a synthetic attention layer, the real one with at most lon_windows lon windows."""
+    full_lon_windows = INPUT_SHAPE[1] // layer['chunk_size'][1]
+    lon_windows = min(lon_windows, full_lon_windows) if lon_windows else full_lon_windows
+    return (lon_windows, 2 * layer['lat_windows'], layer['num_heads'], TOKENS, TOKENS)
+
+def build_synthetic_model(model_path, lon_windows=2, seed=0):
+    """Write a small model with the inputs, outputs and attention tensor names of Pangu-Weather.
+
+    Each layer is a MatMul of random queries and keys scaled by the previous layer, an Add of a positional
+    bias, an Add of a mask in shifted layers and a Softmax, so every attention variant can be exported and
+    derived as in the real model. The forecast scales the inputs by the last layer.
+    """
+    rng = np.random.default_rng(seed)
+    nodes, initializers = [helper.make_node('ReduceMean', ['input_surface'], ['/synthetic/scale_0'], keepdims=0)], []
+    scale = '/synthetic/scale_0'
+    for layer_index, layer in enumerate(default_layers()):
+        shape = synthetic_layer_shape(layer, lon_windows)
+        pre_bias, post_bias, post_softmax = (layer[variant] for variant in ATTENTION_VARIANTS)
+        initializers += [
+            numpy_helper.from_array(rng.standard_normal(shape[:3] + (TOKENS, KEY_SIZE), dtype=np.float32), f'query_{layer_index}'),
+            numpy_helper.from_array(rng.standard_normal(shape[:3] + (KEY_SIZE, TOKENS), dtype=np.float32), f'key_{layer_index}'),
+            numpy_helper.from_array(0.1 * rng.standard_normal((1, 1, shape[2], TOKENS, TOKENS), dtype=np.float32), f'bias_{layer_index}'),
+        ]
+        nodes += [
+            helper.make_node('Mul', [f'query_{layer_index}', scale], [f'/synthetic/query_{layer_index}']),
+            helper.make_node('MatMul', [f'/synthetic/query_{layer_index}', f'key_{layer_index}'], [pre_bias]),
+            helper.make_node('Add', [pre_bias, f'bias_{layer_index}'], [post_bias]),
+        ]
+        scores = post_bias
+        if layer['shifted']:
+            mask = np.zeros((1, shape[1], 1, TOKENS, TOKENS), dtype=np.float32)
+            mask[:, -1, :, :TOKENS // 2, TOKENS // 2:] = -100
+            initializers.append(numpy_helper.from_array(mask, f'mask_{layer_index}'))
+            nodes.append(helper.make_node('Add', [post_bias, f'mask_{layer_index}'], [f'/synthetic/masked_{layer_index}']))
+            scores = f'/synthetic/masked_{layer_index}'
+        scale = f'/synthetic/scale_{layer_index + 1}'
+        nodes += [helper.make_node('Softmax', [scores], [post_softmax], axis=-1),
+                  helper.make_node('ReduceMean', [post_softmax], [scale], keepdims=0)]
+    nodes += [helper.make_node('Mul', ['input', scale], ['output']),
+              helper.make_node('Mul', ['input_surface', scale], ['output_surface'])]
+
+    upper_shape, surface_shape = [len(UPPER_VARS), NUM_LEVELS, *INPUT_SHAPE], [len(SURFACE_VARS), *INPUT_SHAPE]
+    graph = helper.make_graph(nodes, 'synthetic_pangu_weather', [
+        helper.make_tensor_value_info('input', TensorProto.FLOAT, upper_shape),
+        helper.make_tensor_value_info('input_surface', TensorProto.FLOAT, surface_shape),
+    ], [
+        helper.make_tensor_value_info('output', TensorProto.FLOAT, upper_shape),
+        helper.make_tensor_value_info('output_surface', TensorProto.FLOAT, surface_shape),
+    ], initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 17)])
+    model.ir_version = 8
+    onnx.checker.check_model(model)
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    onnx.save(model, model_path)
+
+def build_synthetic_store(store_path, num_timesteps, seed=0):
+    """Write a zarr store laid out like the WeatherBench2 Pangu dataset, one timestep per chunk.
+
+    The fields are smooth waves with a little noise, so they compress about as well as weather data.
+    """
+    rng = np.random.default_rng(seed)
+    latitude = np.linspace(90, -90, INPUT_SHAPE[0], dtype=np.float32)
+    longitude = np.linspace(0, 360, INPUT_SHAPE[1], endpoint=False, dtype=np.float32)
+    wave = np.cos(np.radians(latitude))[:, None] * np.sin(np.radians(longitude))[None, :]
+    times = pd.date_range(START_TIME, periods=num_timesteps, freq='12h')
+    for time_index, time in enumerate(times):
+        data_vars = {}
+        for var_index, var in enumerate(SURFACE_VARS + UPPER_VARS):
+            levels = (NUM_LEVELS,) if var in UPPER_VARS else ()
+            field = (var_index + 1) * np.roll(wave, 4 * time_index, axis=1)
+            field = np.broadcast_to(field, levels + INPUT_SHAPE) + 0.01 * rng.standard_normal(levels + INPUT_SHAPE, dtype=np.float32)
+            dims = ('time', 'prediction_timedelta') + (('level',) if levels else ()) + ('latitude', 'longitude')
+            data_vars[var] = (dims, field.astype(np.float32)[None, None])
+        ds = xr.Dataset(data_vars, coords={
+            'time': [time], 'prediction_timedelta': [np.timedelta64(0, 'h')], 'level': np.linspace(50, 1000, NUM_LEVELS),
+            'latitude': latitude, 'longitude': longitude})
+        if time_index == 0:
+            ds.to_zarr(store_path, mode='w', encoding={'time': {'units': 'hours since 1970-01-01', 'dtype': 'int64'}})
+        else:
+            ds.to_zarr(store_path, append_dim='time')
+
+def run_download(work_dir, options):
+    """Download every synthetic timestep from the zarr store into input_data."""
+    paths = work_paths(work_dir)
+    steps = timesteps(options['num_timesteps'])
+    download_data.main(steps[0][0], steps[-1][0], base_dir=paths['input_data'], zarr_path=paths['store.zarr'],
+                       block_size=options['block_size'])
+
+def profile_summary(profile_path, top=5):
+    """Total kernel time in milliseconds of the most expensive operator types of an ORT profile."""
+    with open(profile_path) as profile_file:
+        events = json.load(profile_file)
+    totals = {}
+    for event in events:
+        if event.get('cat') == 'Node' and event.get('name', '').endswith('_kernel_time'):
+            op_name = event.get('args', {}).get('op_name', event['name'])
+            totals[op_name] = totals.get(op_name, 0) + event['dur'] / 1000
+    return {op_name: round(total, 3) for op_name, total in sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]}
+
+def run_activations(work_dir, options):
+    """Run the synthetic model on every timestep and save the attention activations to output_data."""
+    paths = work_paths(work_dir)
+    profile_prefix = os.path.join(paths['profiles'], 'activations') if options['ort_profile'] else None
+    if profile_prefix is not None:
+        os.makedirs(paths['profiles'], exist_ok=True)
+    session, output_names = prepare_session(paths['checkpoints'], options['model_num'], options['intermediate_layers'],
+                                            options['num_threads'], activations_only=options['activations_only'],
+                                            tuned=options['tuned'], attention_variant=options['attention_variant'],
+                                            profile_prefix=profile_prefix)
+    runner = create_runner(session, output_names, io_binding=options['tuned'])
+    for data_date, data_time in timesteps(options['num_timesteps']):
+        process_timestep(session, output_names, paths['input_data'], paths['output_data'], data_date, data_time, runner=runner)
+    if profile_prefix is not None:
+        profile_path = session.end_profiling()
+        return {'ort_profile': profile_path, 'ort_ops_ms': profile_summary(profile_path)}
+    return {}
+
+def run_format(work_dir, options):
+    """Format the inputs and saved activations of every timestep into the web app layout."""
+    paths = work_paths(work_dir)
+    for data_date, data_time in timesteps(options['num_timesteps']):
+        format_timestep(paths['src'], paths['input_data'], paths['output_data'], data_date, data_time, options['intermediate_layers'],
+                        attention_dtype=options['attention_dtype'], attention_variant=options['attention_variant'],
+                        models_dir=paths['checkpoints'], model_num=options['model_num'])
+
+STAGES = {'download': run_download, 'activations': run_activations, 'format': run_format}
+
+def read_io():
+    """Bytes read and written by this process, from /proc/self/io, or None where it is not available."""
+    try:
+        with open('/proc/self/io') as io_file:
+            counters = dict(line.split(': ') for line in io_file.read().splitlines())
+    except OSError:
+        return None
+    return {name: int(counters[name]) for name in ['rchar', 'wchar', 'read_bytes', 'write_bytes']}
+
+def list_files(directory):
+    """Size of every file under a directory, by path."""
+    return {os.path.join(root, name): os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(directory) for name in names}
+
+def measure_stage(stage, work_dir, options, verbose=False):
+    """Run one stage and measure its wall time, CPU time, peak RSS, I/O and the files it created.
+
+    Meant to run in a fresh process, so the peak RSS and I/O counters belong to this stage alone. Output
+    printed by the stage is discarded unless verbose.
+    """
+    files_before = list_files(work_dir)
+    io_before = read_io()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = perf_counter()
+    with redirect_stdout(None if verbose else io.StringIO()):
+        extra = STAGES[stage](work_dir, options) or {}
+    wall_time = perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    io_after = read_io()
+    files_after = list_files(work_dir)
+
+    created = [path for path in files_after if path not in files_before]
+    return {
+        'wall_time_s': round(wall_time, 3),
+        'cpu_time_s': round(usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime, 3),
+        'peak_rss_mib': round(usage.ru_maxrss / 1024, 1),
+        'read_bytes': io_after['rchar'] - io_before['rchar'] if io_before else None,
+        'written_bytes': io_after['wchar'] - io_before['wchar'] if io_before else None,
+        'disk_read_bytes': io_after['read_bytes'] - io_before['read_bytes'] if io_before else None,
+        'disk_written_bytes': io_after['write_bytes'] - io_before['write_bytes'] if io_before else None,
+        'files_created': len(created),
+        'bytes_created': sum(files_after[path] for path in created),
+        **extra,
+    }
+
+def write_record(record, output_path=None):
+    """Print a metrics record as one JSON line, and append it to output_path if given."""
+    line = json.dumps(record)
+    print(line, flush=True)
+    if output_path is not None:
+        with open(output_path, 'a') as output_file:
+            output_file.write(line + '\n')
+
+def run_benchmark(work_dir, options, stages=STAGE_NAMES, repeats=1, output_path=None, verbose=False):
+    """Run the pipeline stages on the synthetic data in work_dir and write a metrics record for each stage.
+
+    Each stage runs in a fresh process. Every stage up to the last of stages runs, since each reads the
+    outputs of the one before, but only those in stages are reported. The model cache is kept between
+    repeats, so the first repeat includes building the modified model and later ones reuse it.
+    """
+    paths = work_paths(work_dir)
+    last_stage = max(STAGE_NAMES.index(stage) for stage in stages)
+    context = multiprocessing.get_context('spawn')
+    records = []
+    for repeat in range(repeats):
+        for name in ['input_data', 'output_data', 'src', 'profiles']:
+            shutil.rmtree(paths[name], ignore_errors=True)
+        for stage in STAGE_NAMES[:last_stage + 1]:
+            with context.Pool(1) as pool:
+                metrics = pool.apply(measure_stage, (stage, work_dir, options, verbose))
+            if stage in stages:
+                record = {'stage': stage, 'repeat': repeat, 'timesteps': options['num_timesteps'], **metrics, 'options': options}
+                write_record(record, output_path)
+                records.append(record)
+    return records
+
+def main(args):
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pangu_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    paths = work_paths(work_dir)
+    options = {'num_timesteps': args.num_timesteps, 'model_num': args.model_num, 'intermediate_layers': args.intermediate_layers,
+               'num_threads': args.num_threads, 'activations_only': args.activations_only, 'tuned': args.tuned,
+               'attention_variant': args.attention_variant, 'attention_dtype': args.attention_dtype,
+               'block_size': args.block_size, 'lon_windows': args.lon_windows, 'seed': args.seed, 'ort_profile': args.ort_profile}
+    try:
+        # The synthetic model and store of a reused work directory are rebuilt only if they were made differently.
+        synthetic = {'model_num': args.model_num, 'num_timesteps': args.num_timesteps, 'lon_windows': args.lon_windows, 'seed': args.seed}
+        synthetic_path = os.path.join(work_dir, SYNTHETIC_NAME)
+        previous = None
+        if os.path.exists(synthetic_path):
+            with open(synthetic_path) as synthetic_file:
+                previous = json.load(synthetic_file)
+        if previous != synthetic:
+            shutil.rmtree(paths['checkpoints'], ignore_errors=True)
+            shutil.rmtree(paths['store.zarr'], ignore_errors=True)
+            build_synthetic_model(os.path.join(paths['checkpoints'], f'pangu_weather_{args.model_num}.onnx'),
+                                  lon_windows=args.lon_windows, seed=args.seed)
+            build_synthetic_store(paths['store.zarr'], args.num_timesteps, seed=args.seed)
+            with open(synthetic_path, 'w') as synthetic_file:
+                json.dump(synthetic, synthetic_file, indent=4)
+        run_benchmark(work_dir, options, stages=args.stages, repeats=args.repeats, output_path=args.output, verbose=args.verbose)
+    finally:
+        if args.work_dir is None and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the download, activation and format stages on a synthetic model and data, writing JSON-lines metrics per stage.')
+    parser.add_argument('--stages', choices=STAGE_NAMES, nargs='+', default=STAGE_NAMES, help='Stages to report, the stages before them still run.')
+    parser.add_argument('--num_timesteps', type=int, default=2, help='Number of synthetic timesteps.')
+    parser.add_argument('--repeats', type=int, default=1, help='Number of times to run the stages.')
+    parser.add_argument('--model_num', type=int, default=24, help='Model number of the synthetic model.')
+    parser.add_argument('--intermediate_layers', type=int, nargs='+', default=[0, 1, 2, 3], help='Indices of intermediate layers to export and format.')
+    parser.add_argument('--lon_windows', type=int, default=2, help='Lon windows per synthetic attention layer, at most those of the real model, or 0 for all of them.')
+    parser.add_argument('--num_threads', type=int, default=4, help='Number of threads to use for ONNX Runtime session.')
+    parser.add_argument('--activations_only', action='store_true', help='Only run the model up to the deepest intermediate layer.')
+    parser.add_argument('--tuned', action='store_true', help='Use the tuned session mode.')
+    parser.add_argument('--attention_variant', choices=ATTENTION_VARIANTS, default='post_bias', help='Attention to export and format.')
+    parser.add_argument('--attention_dtype', choices=ATTENTION_DTYPES, default='float32', help='Storage type of the formatted attention.')
+    parser.add_argument('--block_size', type=int, help='Timesteps read per request in the download stage.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic model and data.')
+    parser.add_argument('--ort_profile', action='store_true', help='Record an ONNX Runtime profile of the activation stage and report its most expensive operators.')
+    parser.add_argument('--work_dir', type=str, help='Directory for the synthetic model, data and outputs, kept afterwards. By default a temporary directory.')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary work directory.')
+    parser.add_argument('--output', type=str, help='Also append the metrics to this JSON-lines file.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the stages.')
+
+    args = parser.parse_args()
+    main(args)
@@ -1,9 +1,18 @@
 import xarray as xr
 import numpy as np
 import os
-from tqdm import trange
+from tqdm import tqdm
 from time import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import argparse
+from input_store import InputStore, STORE_DIR_NAME
+
+ZARR_PATH = 'gs://weatherbench2/datasets/pangu/2018-2022_0012_0p25.zarr'
+SURFACE_VARS = ['mean_sea_level_pressure', '10m_u_component_of_wind',
+                '10m_v_component_of_wind', '2m_temperature']
+UPPER_VARS = ['geopotential', 'specific_humidity', 'temperature',
+              'u_component_of_wind', 'v_component_of_wind']
 
 def log_time(func):
     """Decorator to log the time taken by a function."""
@@ -17,8 +26,9 @@ def log_time(func):
     return wrapper
 
 @log_time
-def load_dataset():
-    return xr.open_zarr('gs://weatherbench2/datasets/pangu/2018-2022_0012_0p25.zarr')
+def load_dataset(zarr_path=ZARR_PATH):
+    # Read the zarr arrays directly, the downloader fetches its own chunk-aligned blocks.
+    return xr.open_zarr(zarr_path, chunks=None)
 
 def prepare_directory(base_dir, date_str, time_str):
     dir_path = os.path.join(base_dir, date_str, time_str)
@@ -26,42 +36,128 @@ def prepare_directory(base_dir, date_str, time_str):
         os.makedirs(dir_path)
     return dir_path
 
-def main(start_date, end_date, base_dir='input_data'):
-    ds = load_dataset()
+def timestep_strings(timestamp):
+    """Date and time of a timestep as YYYY-MM-DD and HH:MM."""
+    return np.datetime_as_string(timestamp, unit='D'), np.datetime_as_string(timestamp, unit='m')[-5:]
+
+def expected_shapes(ds):
+    """Shapes of the surface and upper input arrays of one timestep."""
+    surface_shape = (len(SURFACE_VARS),) + ds[SURFACE_VARS[0]].isel(time=0, prediction_timedelta=0).shape
+    upper_shape = (len(UPPER_VARS),) + ds[UPPER_VARS[0]].isel(time=0, prediction_timedelta=0).shape
+    return {'input_surface': surface_shape, 'input_upper': upper_shape}
+
+def is_downloaded(dir_path, shapes, verify=False):
+    """Return True if both inputs of a timestep exist, and with verify, hold float32 arrays of the expected shapes."""
+    for name, shape in shapes.items():
+        path = os.path.join(dir_path, f"{name}.npy")
+        if not os.path.exists(path):
+            return False
+        if verify:
+            try:
+                array = np.load(path, mmap_mode='r')
+            except (ValueError, OSError):
+                return False
+            if array.shape != shape or array.dtype != np.float32:
+                return False
+    return True
 
-    ds_filtered = ds.sel(time=slice(start_date, end_date))
+def save_atomic(path, array):
+    """Save an array through a temporary file so an interrupted run never leaves a partial file."""
+    with open(f"{path}.tmp", 'wb') as tmp_file:
+        np.save(tmp_file, array)
+    os.replace(f"{path}.tmp", path)
 
-    progress_bar = trange(len(ds_filtered['time']), desc="Processing time steps")
+def time_chunk_size(ds):
+    """Number of timesteps in one chunk of the store."""
+    return max(ds[var].encoding.get('preferred_chunks', {}).get('time', 1) for var in SURFACE_VARS + UPPER_VARS)
 
-    for i in progress_bar:
-        current_time = ds_filtered['time'].isel(time=i).values
-        date_str = np.datetime_as_string(current_time, unit='D')
-        time_str = np.datetime_as_string(current_time, unit='m')[-5:]
+def plan_blocks(time_indices, block_size):
+    """Group store time indices into blocks that never cross a multiple of block_size."""
+    blocks = {}
+    for index in time_indices:
+        blocks.setdefault(index // block_size, []).append(index)
+    return [slice(indices[0], indices[-1] + 1) for _, indices in sorted(blocks.items())]
 
-        progress_bar.set_description(f"Saving Data: {date_str} {time_str}")
+def fetch_variable(ds, var, block):
+    """Read a block of timesteps of one variable in a single request."""
+    return ds[var].isel(time=block, prediction_timedelta=0).values.astype(np.float32)
 
-        dir_path = prepare_directory(base_dir, date_str, time_str)
+def write_block(ds, block, arrays, pending, base_dir, store=None):
+    """Stack the variables of each pending timestep in a block and save them, or append them to the input store."""
+    for offset, index in enumerate(range(block.start, block.stop)):
+        if index not in pending:
+            continue
+        if store is not None:
+            store.append(*timestep_strings(ds['time'].values[index]),
+                         np.stack([arrays[var][offset] for var in UPPER_VARS], axis=0),
+                         np.stack([arrays[var][offset] for var in SURFACE_VARS], axis=0))
+            continue
+        dir_path = prepare_directory(base_dir, *timestep_strings(ds['time'].values[index]))
+        save_atomic(os.path.join(dir_path, "input_surface.npy"), np.stack([arrays[var][offset] for var in SURFACE_VARS], axis=0))
+        save_atomic(os.path.join(dir_path, "input_upper.npy"), np.stack([arrays[var][offset] for var in UPPER_VARS], axis=0))
 
-        surface_vars = ['mean_sea_level_pressure', '10m_u_component_of_wind', 
-                        '10m_v_component_of_wind', '2m_temperature']
-        input_surface = np.stack([ds_filtered[var].isel(time=i, prediction_timedelta=0).values.astype(np.float32) 
-                                  for var in surface_vars], axis=0)
+def main(start_date, end_date, base_dir='input_data', zarr_path=ZARR_PATH, block_size=None, max_workers=9,
+         blocks_in_flight=2, verify=False, input_store=False):
+    """Download every timestep between start_date and end_date that is not already in base_dir.
 
-        np.save(os.path.join(dir_path, "input_surface.npy"), input_surface)
+    Timesteps are read in blocks aligned to the time chunks of the store, with every variable of a block
+    fetched concurrently, while the previous block is written. At most blocks_in_flight blocks are fetched ahead
+    of the one being written. With input_store the timesteps are appended to the memory-mapped input store
+    instead of saved as .npy files.
+    """
+    ds = load_dataset(zarr_path)
 
-        upper_vars = ['geopotential', 'specific_humidity', 'temperature', 
-                      'u_component_of_wind', 'v_component_of_wind']
-        input_upper = np.stack([ds_filtered[var].isel(time=i, prediction_timedelta=0).values.astype(np.float32) 
-                                for var in upper_vars], axis=0)
+    chunk_size = time_chunk_size(ds)
+    block_size = chunk_size * max(1, -(-(block_size or chunk_size) // chunk_size))
+    time_range = ds.get_index('time').slice_indexer(start_date, end_date)
+    shapes = expected_shapes(ds)
+    time_values = ds['time'].values
+    store = InputStore(os.path.join(base_dir, STORE_DIR_NAME)) if input_store else None
+    if store is not None:
+        pending = [index for index in range(len(time_values))[time_range] if timestep_strings(time_values[index]) not in store]
+    else:
+        pending = [index for index in range(len(time_values))[time_range]
+                   if not is_downloaded(os.path.join(base_dir, *timestep_strings(time_values[index])), shapes, verify=verify)]
+    skipped = len(range(len(time_values))[time_range]) - len(pending)
+    if skipped:
+        print(f"Skipping {skipped} timesteps already in {base_dir}")
+    if not pending:
+        return
 
-        np.save(os.path.join(dir_path, "input_upper.npy"), input_upper)
+    blocks = deque(plan_blocks(pending, block_size))
+    pending = set(pending)
+    progress_bar = tqdm(total=len(pending), desc="Downloading time steps")
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers) as pool:
+        def submit_next():
+            if blocks:
+                block = blocks.popleft()
+                in_flight.append((block, {var: pool.submit(fetch_variable, ds, var, block) for var in SURFACE_VARS + UPPER_VARS}))
+
+        for _ in range(blocks_in_flight):
+            submit_next()
+        while in_flight:
+            block, futures = in_flight.popleft()
+            arrays = {var: future.result() for var, future in futures.items()}
+            submit_next()
+            write_block(ds, block, arrays, pending, base_dir, store=store)
+            progress_bar.update(len(pending.intersection(range(block.start, block.stop))))
+    progress_bar.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process weather data.')
     parser.add_argument('--start_date', type=str, required=True, help='Start date in YYYY-MM-DD format')
     parser.add_argument('--end_date', type=str, required=True, help='End date in YYYY-MM-DD format')
     parser.add_argument('--dir', type=str, default='input_data', help='Base directory for saving data')
+    parser.add_argument('--zarr_path', type=str, default=ZARR_PATH, help='Path or URL of the zarr store to read from')
+    parser.add_argument('--block_size', type=int, help='Timesteps read per request, rounded up to whole time chunks of the store')
+    parser.add_argument('--max_workers', type=int, default=9, help='Number of concurrent variable reads')
+    parser.add_argument('--blocks_in_flight', type=int, default=2, help='Number of blocks fetched or held in memory at once')
+    parser.add_argument('--input_store', action='store_true', help='Append the timesteps to the memory-mapped input store instead of saving .npy files')
+    parser.add_argument('--verify', action='store_true', help='Check the shape and type of timesteps already on disk instead of only their presence')
 
     args = parser.parse_args()
-    
-    main(args.start_date, args.end_date, args.dir)
+
+    main(args.start_date, args.end_date, args.dir, zarr_path=args.zarr_path, block_size=args.block_size,
+         max_workers=args.max_workers, blocks_in_flight=args.blocks_in_flight, verify=args.verify,
+         input_store=args.input_store)
@@ -2,28 +2,49 @@ import os
 import json
 import numpy as np
 import argparse
-from tqdm import tqdm, trange
+from tqdm import tqdm
 import shutil
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+from attention_constants import constant_window
+from contextlib import contextmanager
+from functools import lru_cache
+from input_store import load_inputs, input_sources, file_fingerprint, INPUT_NAMES
+from model_cache import write_json_atomic
+from attention_variants import ATTENTION_VARIANTS, EXPORTED_VARIANTS, attention_view, softmax_scores, variant_layer_name
+from index_graph import attention_layers, WINDOW_SHAPE
 
-# Define the intermediate layer names
-INTERMEDIATE_LAYER_NAMES = [
-    '/b1/Add_output_0', 
-    '/b1/Add_3_output_0',
-    '/b1/Add_7_output_0', 
-    '/b1/Add_10_output_0',
-    '/b1/Add_14_output_0', 
-    '/b1/Add_17_output_0',
-    '/b1/Add_21_output_0', 
-    '/b1/Add_24_output_0',
-    '/b1/Add_28_output_0', 
-    '/b1/Add_31_output_0',
-    '/b1/Add_35_output_0', 
-    '/b1/Add_38_output_0',
-    '/b1/Add_42_output_0', 
-    '/b1/Add_45_output_0',
-    '/b1/Add_49_output_0',
-    '/b1/Add_52_output_0',
-]
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where the available data index is updated without a lock.
+    fcntl = None
+
+MAP_WRITE_THREADS = min(8, os.cpu_count() or 1)
+
+ATTENTION_PACKED_NAME = 'attention.bin'
+ATTENTION_INDEX_NAME = 'index.json'
+ATTENTION_DTYPES = ['float32', 'float16', 'uint8', 'int8']
+QUANTIZED_LEVELS = {'uint8': 255, 'int8': 127}
+QUANTIZED_HEADER_BYTES = 8
+SPARSE_DTYPES = ['float32', 'float16']
+SPARSE_RECORD_ALIGNMENT = 4
+
+ATTENTION_STATS_NAME = 'stats.bin'
+ATTENTION_STATS_INDEX_NAME = 'stats.json'
+ATTENTION_METRICS = ['entropy', 'max_weight', 'mean_distance', 'diagonal_mass']
+
+MANIFEST_NAME = 'manifest.json'
+AVAILABLE_DATA_NAME = 'available_data.json'
+
+# Layer names, head counts and window configs come from the graph index of the model, or constants.py if it
+# has not been indexed, so they are looked up for the models_dir and model_num of each call.
+def num_attention_heads(layer_index, models_dir='checkpoints', model_num=None):
+    """Number of attention heads of an intermediate layer."""
+    return attention_layers(models_dir, model_num)[layer_index]['num_heads']
+
+def map_chunk_sizes(models_dir='checkpoints', model_num=None):
+    """Sorted (lat, lon) map chunk sizes of the window configs of the attention layers."""
+    return sorted({tuple(layer['chunk_size']) for layer in attention_layers(models_dir, model_num)})
 
 def clear_directory(directory, verbose=False):
     """Remove all files and subdirectories in the specified directory."""
@@ -33,95 +54,575 @@ def clear_directory(directory, verbose=False):
     if verbose:
         print(f"Cleared directory: {directory}")
 
-def save_map_data(input_data, chunk_size_lat, chunk_size_lon, config_name, data_type, roll_data=False, verbose=False):
-    if roll_data:
-        input_data = np.roll(input_data, shift=(chunk_size_lat // 2, chunk_size_lon // 2), axis=(-2, -1))
-    
-    for lat_index in range(0, input_data.shape[1], chunk_size_lat):
-        for lon_index in range(0, input_data.shape[2], chunk_size_lon):
-            lat_end = min(lat_index + chunk_size_lat, input_data.shape[1])
-            lon_end = min(lon_index + chunk_size_lon, input_data.shape[2])
-            chunk_data = input_data[:, lat_index:lat_end, lon_index:lon_end]
-            
-            map_dir = os.path.join(args.src_dir, 'bin', args.data_date, args.data_time, config_name, 'map')
-            os.makedirs(map_dir, exist_ok=True)
-            
-            chunk_filename = f"{data_type}_{lat_index}_{lon_index}.bin"
-            chunk_data.tofile(os.path.join(map_dir, chunk_filename))
+def tile_groups(size, chunk_size):
+    """Split an axis into a group of full chunks and a group holding the final partial chunk, if any."""
+    num_full = size // chunk_size
+    groups = []
+    if num_full:
+        groups.append((0, num_full, chunk_size))
+    if size % chunk_size:
+        groups.append((num_full * chunk_size, 1, size % chunk_size))
+    return groups
+
+def axis_runs(start, count, chunk_size, size, shift):
+    """Map the chunks of a group on a rolled axis back onto the unrolled axis.
+
+    Returns runs of (first chunk, number of chunks, first index in chunk, last index in chunk, source index)
+    over which the source index grows by chunk_size per chunk and by one within a chunk, so each run can be
+    read as a strided view of the unrolled data.
+    """
+    runs = []
+    open_runs = {}
+    for chunk in range(count):
+        first = (start + chunk * chunk_size - shift) % size
+        if first + chunk_size <= size:
+            pieces = [(0, chunk_size, first)]
+        else:
+            pieces = [(0, size - first, first), (size - first, chunk_size, 0)]
+        for inner_start, inner_end, source in pieces:
+            run = open_runs.get((inner_start, inner_end))
+            if run is not None and run[0] + run[1] == chunk and run[4] + run[1] * chunk_size == source:
+                run[1] += 1
+            else:
+                run = [chunk, 1, inner_start, inner_end, source]
+                open_runs[(inner_start, inner_end)] = run
+                runs.append(run)
+    return runs
+
+def tile_map_data(input_data, chunk_size_lat, chunk_size_lon, roll_data=False):
+    """Cut a (channel, level, lat, lon) array into map tiles without rolling or copying the full field.
+
+    Tiles are copied once, straight from strided views of the input into (level, lat tile, lon tile, channel,
+    lat, lon) order so every tile is contiguous. Rolling only changes which views are read. Yields the lat and
+    lon start index of each tile along with the tiles of a group of equally sized tiles.
+    """
+    channels, levels, size_lat, size_lon = input_data.shape
+    shift_lat, shift_lon = (chunk_size_lat // 2, chunk_size_lon // 2) if roll_data else (0, 0)
+    stride_channel, stride_level, stride_lat, stride_lon = input_data.strides
+    for lat_start, lat_count, lat_size in tile_groups(size_lat, chunk_size_lat):
+        lat_runs = axis_runs(lat_start, lat_count, lat_size, size_lat, shift_lat)
+        for lon_start, lon_count, lon_size in tile_groups(size_lon, chunk_size_lon):
+            lon_runs = axis_runs(lon_start, lon_count, lon_size, size_lon, shift_lon)
+            tiles = np.empty((levels, lat_count, lon_count, channels, lat_size, lon_size), dtype=input_data.dtype)
+            for lat_chunk, lat_chunks, lat_inner_start, lat_inner_end, lat_source in lat_runs:
+                for lon_chunk, lon_chunks, lon_inner_start, lon_inner_end, lon_source in lon_runs:
+                    source = np.lib.stride_tricks.as_strided(
+                        input_data[:, :, lat_source:, lon_source:],
+                        shape=(levels, lat_chunks, lon_chunks, channels, lat_inner_end - lat_inner_start, lon_inner_end - lon_inner_start),
+                        strides=(stride_level, lat_size * stride_lat, lon_size * stride_lon, stride_channel, stride_lat, stride_lon),
+                        writeable=False,
+                    )
+                    tiles[:, lat_chunk:lat_chunk + lat_chunks, lon_chunk:lon_chunk + lon_chunks, :,
+                          lat_inner_start:lat_inner_end, lon_inner_start:lon_inner_end] = source
+            yield lat_start + np.arange(lat_count) * lat_size, lon_start + np.arange(lon_count) * lon_size, tiles
+
+def map_tile(input_data, level, lat_index, lon_index, chunk_size_lat, chunk_size_lon, roll_data=False):
+    """Cut the single (channel, lat, lon) map tile starting at lat_index and lon_index of one level.
+
+    Matches the tiles of tile_map_data, for serving one tile on request. Raises IndexError if no tile starts there.
+    """
+    _, levels, size_lat, size_lon = input_data.shape
+    if not (0 <= level < levels and 0 <= lat_index < size_lat and 0 <= lon_index < size_lon
+            and lat_index % chunk_size_lat == 0 and lon_index % chunk_size_lon == 0):
+        raise IndexError(f"No {chunk_size_lat}x{chunk_size_lon} tile at level {level}, lat {lat_index}, lon {lon_index}")
+    shift_lat, shift_lon = (chunk_size_lat // 2, chunk_size_lon // 2) if roll_data else (0, 0)
+    lat_rows = (lat_index + np.arange(min(chunk_size_lat, size_lat - lat_index)) - shift_lat) % size_lat
+    lon_cols = (lon_index + np.arange(min(chunk_size_lon, size_lon - lon_index)) - shift_lon) % size_lon
+    return input_data[:, level][:, lat_rows][:, :, lon_cols]
+
+def write_tiles(tiles):
+    """Write a batch of (path, tile) pairs."""
+    for path, tile in tiles:
+        with open(path, 'wb') as tile_file:
+            tile_file.write(memoryview(tile))
+
+def save_map_data(input_data, bin_dir, data_type, upper=False, chunk_sizes=None, verbose=False):
+    """Write the map tiles of every chunk config, shifted and unshifted, for a (channel, level, lat, lon) array.
+
+    Upper data gets one config directory per pressure level, surface data expects a single level. chunk_sizes
+    defaults to map_chunk_sizes(). Tiles are written in batches, one per config directory and tile group, on a
+    thread pool.
+    """
+    start_time = time()
+    num_tiles = 0
+    with ThreadPoolExecutor(MAP_WRITE_THREADS) as executor:
+        for chunk_size_lat, chunk_size_lon in chunk_sizes or map_chunk_sizes():
+            for roll_data in (False, True):
+                map_dirs = []
+                for level in range(input_data.shape[1]):
+                    config_name = f'config_{chunk_size_lat}x{chunk_size_lon}'
+                    config_name += f'_upper_{level}' if upper else ''
+                    config_name += '_shifted' if roll_data else ''
+                    map_dir = os.path.join(bin_dir, config_name, 'map')
+                    os.makedirs(map_dir, exist_ok=True)
+                    map_dirs.append(map_dir)
+
+                batches = []
+                for lat_indices, lon_indices, tiles in tile_map_data(input_data, chunk_size_lat, chunk_size_lon, roll_data=roll_data):
+                    for level, map_dir in enumerate(map_dirs):
+                        batch = [
+                            (os.path.join(map_dir, f"{data_type}_{lat_index}_{lon_index}.bin"), tiles[level, i, j])
+                            for i, lat_index in enumerate(lat_indices)
+                            for j, lon_index in enumerate(lon_indices)
+                        ]
+                        batches.append(executor.submit(write_tiles, batch))
+                        num_tiles += len(batch)
+                for batch in batches:
+                    batch.result()
+    if verbose:
+        print(f"Saved {num_tiles} {data_type} map tiles - Time Taken: {time() - start_time:.2f}")
+
+def save_attention_files(attention_output, attention_dir, num_heads, verbose=False):
+    """Write every window and head of an attention layer to its own binary file."""
+    for lon in range(attention_output.shape[0]):
+        for lat_pl in range(attention_output.shape[1]):
+            for head in range(num_heads):
+                attention_chunk = attention_output[lon, lat_pl, head, :, :]
+                attention_filename = f"attention_{lon}_{lat_pl}_{head}.bin"
+                attention_chunk.tofile(os.path.join(attention_dir, attention_filename))
+                if verbose:
+                    print(f"Saved attention chunk: {attention_filename}")
+
+def quantize_attention(block, dtype):
+    """Encode a block of attention tiles, shaped (..., rows, cols), as dtype.
+
+    The integer types store each tile with its own scale and offset, uint8 spanning the tile's range and
+    int8 symmetric around zero. Returns the encoded tiles, the (..., 2) per-tile scale and offset (None for
+    the float types) and the maximum absolute reconstruction error.
+    """
+    block = np.asarray(block, dtype=np.float32)
+    if dtype == 'float32':
+        return block, None, 0.0
+    if dtype == 'float16':
+        encoded = block.astype(np.float16)
+        return encoded, None, float(np.abs(encoded.astype(np.float32) - block).max())
+
+    if dtype == 'uint8':
+        offset = block.min(axis=(-2, -1))
+        scale = (block.max(axis=(-2, -1)) - offset) / QUANTIZED_LEVELS[dtype]
+    else:
+        offset = np.zeros(block.shape[:-2], dtype=np.float32)
+        scale = np.abs(block).max(axis=(-2, -1)) / QUANTIZED_LEVELS[dtype]
+    scale[scale == 0] = 1
+    low = 0 if dtype == 'uint8' else -QUANTIZED_LEVELS[dtype]
+    encoded = np.rint((block - offset[..., None, None]) / scale[..., None, None])
+    encoded = encoded.clip(low, QUANTIZED_LEVELS[dtype]).astype(dtype)
+    reconstructed = encoded * scale[..., None, None] + offset[..., None, None]
+    scales = np.stack([scale, offset], axis=-1).astype(np.float32)
+    return encoded, scales, float(np.abs(reconstructed - block).max())
+
+def save_attention_index(attention_dir, shape, dtype, header_bytes=0, max_error=0.0, **fields):
+    """Describe the layout of a packed attention file so a slice can be read with a range request.
+
+    Each slice is stored as a record of header_bytes, holding its float32 scale and offset for quantised
+    data, followed by its values. Extra fields, such as the record offsets of sparse data, are added as given.
+    """
+    index = {
+        'file': ATTENTION_PACKED_NAME,
+        'shape': [int(dim) for dim in shape],
+        'dtype': np.dtype(dtype).name,
+        'offset': 0,
+        'header_bytes': header_bytes,
+        'record_bytes': header_bytes + int(np.prod(shape[3:])) * np.dtype(dtype).itemsize,
+        'max_error': max_error,
+        **fields,
+    }
+    with open(os.path.join(attention_dir, ATTENTION_INDEX_NAME), 'w') as index_file:
+        json.dump(index, index_file, indent=4)
+
+def save_attention_packed(attention_output, attention_dir, num_heads, dtype='float32', verbose=False):
+    """Write every window and head of an attention layer to a single file, in (lon, lat_pl, head) order.
+
+    The record for (lon, lat_pl, head) starts at ((lon * lat_pls + lat_pl) * heads + head) * record_bytes.
+    Returns the maximum reconstruction error of the chosen dtype.
+    """
+    max_error = 0.0
+    header_bytes = QUANTIZED_HEADER_BYTES if dtype in QUANTIZED_LEVELS else 0
+    with open(os.path.join(attention_dir, ATTENTION_PACKED_NAME), 'wb') as packed_file:
+        for lon in range(attention_output.shape[0]):
+            encoded, scales, error = quantize_attention(attention_output[lon, :, :num_heads], dtype)
+            max_error = max(max_error, error)
+            if scales is None:
+                np.ascontiguousarray(encoded).tofile(packed_file)
+                continue
+            records = np.empty(encoded.shape[:-2], dtype=[
+                ('scale', '<f4'), ('offset', '<f4'), ('values', encoded.dtype, encoded.shape[-2:])])
+            records['scale'] = scales[..., 0]
+            records['offset'] = scales[..., 1]
+            records['values'] = encoded
+            records.tofile(packed_file)
+    shape = (attention_output.shape[0], attention_output.shape[1], num_heads) + attention_output.shape[3:]
+    save_attention_index(attention_dir, shape, dtype, header_bytes=header_bytes, max_error=max_error)
+    if verbose:
+        print(f"Saved packed attention: {os.path.join(attention_dir, ATTENTION_PACKED_NAME)}")
+    return max_error
+
+def attention_softmax(block):
+    """Softmax of a block of attention logits, shaped (..., queries, keys), over the keys."""
+    block = np.asarray(block, dtype=np.float32)
+    weights = np.exp(block - block.max(axis=-1, keepdims=True))
+    return weights / weights.sum(axis=-1, keepdims=True)
+
+def sparsify_attention(block, top_k=None, mass=None):
+    """Keep the largest softmax weights of every query in a block of attention logits.
+
+    Each query keeps its top_k keys, or the fewest keys whose weights add up to at least mass. Returns the
+    (..., queries) number of keys kept per query, the kept weights and key indices in descending weight order,
+    flattened in (..., query) order, and the largest weight mass dropped from any query.
+    """
+    weights = attention_softmax(block)
+    order = np.argsort(-weights, axis=-1, kind='stable')
+    sorted_weights = np.take_along_axis(weights, order, axis=-1)
+    cumulative = np.cumsum(sorted_weights, axis=-1)
+    num_keys = weights.shape[-1]
+    if top_k is not None:
+        counts = np.full(weights.shape[:-1], min(top_k, num_keys))
+    else:
+        counts = np.minimum((cumulative < mass).sum(axis=-1) + 1, num_keys)
+    kept = np.arange(num_keys) < counts[..., None]
+    kept_mass = np.take_along_axis(cumulative, counts[..., None] - 1, axis=-1)
+    return counts, sorted_weights[kept], order[kept], float((1 - kept_mass).max())
+
+def masked_block(attention_output, lon, num_heads, mask=None):
+    """The (lat_pl, head, query, key) logits of one lon window, with the shift mask added if the layer has one."""
+    block = np.asarray(attention_output[lon, :, :num_heads], dtype=np.float32)
+    return block if mask is None else block + constant_window(mask, lon)[:, :num_heads]
+
+def save_attention_sparse(attention_output, attention_dir, num_heads, top_k=None, mass=None, dtype='float32', mask=None, verbose=False):
+    """Write the softmax weights of an attention layer to a single file, keeping only the largest per query.
+
+    The softmax is taken over the stored scores plus the shift mask, if given, as in the model. Each
+    (lon, lat_pl, head) record holds the uint8 number of keys kept per query, the kept weights as dtype
+    and their uint8 key indices, grouped by query and padded to SPARSE_RECORD_ALIGNMENT bytes. Records vary in
+    size, so their byte offsets are saved in the index. Returns the largest weight mass dropped from a query.
+    """
+    max_dropped = 0.0
+    record_offsets = [0]
+    with open(os.path.join(attention_dir, ATTENTION_PACKED_NAME), 'wb') as packed_file:
+        for lon in range(attention_output.shape[0]):
+            counts, values, indices, dropped = sparsify_attention(masked_block(attention_output, lon, num_heads, mask), top_k=top_k, mass=mass)
+            max_dropped = max(max_dropped, dropped)
+            counts = counts.reshape(-1, counts.shape[-1])
+            bounds = np.concatenate([[0], np.cumsum(counts.sum(axis=-1))])
+            values = values.astype(dtype)
+            indices = indices.astype(np.uint8)
+            records = []
+            for record_index, record_counts in enumerate(counts):
+                start, end = bounds[record_index], bounds[record_index + 1]
+                record = record_counts.astype(np.uint8).tobytes() + values[start:end].tobytes() + indices[start:end].tobytes()
+                record += bytes(-len(record) % SPARSE_RECORD_ALIGNMENT)
+                records.append(record)
+                record_offsets.append(record_offsets[-1] + len(record))
+            packed_file.write(b''.join(records))
+    shape = (attention_output.shape[0], attention_output.shape[1], num_heads) + attention_output.shape[3:]
+    sparse = {'top_k': top_k} if top_k is not None else {'mass': mass}
+    save_attention_index(attention_dir, shape, dtype, max_error=max_dropped, encoding='sparse', sparse=sparse,
+                         record_bytes=None, record_offsets=record_offsets)
+    if verbose:
+        print(f"Saved sparse attention: {os.path.join(attention_dir, ATTENTION_PACKED_NAME)}")
+    return max_dropped
+
+@lru_cache(maxsize=None)
+def token_distances(window_shape=WINDOW_SHAPE):
+    """Euclidean distance in patches between every pair of tokens of a window."""
+    coords = np.stack(np.unravel_index(np.arange(np.prod(window_shape)), window_shape), axis=-1)
+    return np.linalg.norm(coords[:, None] - coords[None], axis=-1).astype(np.float32)
+
+def attention_stats(block):
+    """Summarise every tile of a block of attention logits, shaped (..., queries, keys), by ATTENTION_METRICS.
+
+    Each metric is averaged over the queries of a tile: the entropy of the softmax weights in nats, the largest
+    weight, the weighted distance to the keys in patches and the weight of the query on itself.
+    """
+    weights = attention_softmax(block)
+    entropy = -(weights * np.log(np.maximum(weights, np.finfo(np.float32).tiny))).sum(axis=-1)
+    mean_distance = (weights * token_distances()).sum(axis=-1)
+    diagonal_mass = np.diagonal(weights, axis1=-2, axis2=-1)
+    metrics = [entropy, weights.max(axis=-1), mean_distance, diagonal_mass]
+    return np.stack([metric.mean(axis=-1) for metric in metrics], axis=-1).astype(np.float32)
+
+def save_attention_stats(attention_output, layer_dir, num_heads, mask=None, verbose=False):
+    """Write the (lon, lat_pl, head, metric) statistics of an attention layer to one small file with an index.
+
+    The softmax is taken over the stored scores plus the shift mask, if given, as in the model.
+    """
+    stats = np.stack([attention_stats(masked_block(attention_output, lon, num_heads, mask)) for lon in range(attention_output.shape[0])])
+    stats.tofile(os.path.join(layer_dir, ATTENTION_STATS_NAME))
+    index = {'file': ATTENTION_STATS_NAME, 'shape': list(stats.shape), 'dtype': 'float32', 'metrics': ATTENTION_METRICS}
+    with open(os.path.join(layer_dir, ATTENTION_STATS_INDEX_NAME), 'w') as index_file:
+        json.dump(index, index_file, indent=4)
+    if verbose:
+        print(f"Saved attention statistics: {os.path.join(layer_dir, ATTENTION_STATS_NAME)}")
+
+def remove_attention_stats(layer_dir, verbose=False):
+    """Remove the statistics of an attention layer, if there are any."""
+    for name in (ATTENTION_STATS_INDEX_NAME, ATTENTION_STATS_NAME):
+        if os.path.exists(os.path.join(layer_dir, name)):
+            os.remove(os.path.join(layer_dir, name))
+    if verbose:
+        print(f"Removed attention statistics: {os.path.join(layer_dir, ATTENTION_STATS_NAME)}")
+
+def compare_attention_dtypes(attention_output, num_heads):
+    """Return the bytes per slice and maximum reconstruction error of every attention dtype for one layer."""
+    max_errors = {dtype: 0.0 for dtype in ATTENTION_DTYPES}
+    for lon in range(attention_output.shape[0]):
+        block = np.asarray(attention_output[lon, :, :num_heads], dtype=np.float32)
+        for dtype in ATTENTION_DTYPES:
+            max_errors[dtype] = max(max_errors[dtype], quantize_attention(block, dtype)[2])
+    slice_size = int(np.prod(attention_output.shape[3:]))
+    return {
+        dtype: (slice_size * np.dtype(dtype).itemsize + (QUANTIZED_HEADER_BYTES if dtype in QUANTIZED_LEVELS else 0), max_errors[dtype])
+        for dtype in ATTENTION_DTYPES
+    }
+
+def format_attention(bin_dir, layer_index, attention_output, attention_format='packed', attention_dtype='float32',
+                     attention_top_k=None, attention_mass=None, attention_variant='post_bias', attention_scores=None, attention_mask=None,
+                     models_dir='checkpoints', model_num=None, verbose=False):
+    """Write one attention layer into the web app layout, window by window, in the directory of its variant.
+
+    With attention_top_k or attention_mass only the largest softmax weights of each query are kept, taken over
+    attention_scores plus attention_mask as in the model. The scores default to the layer itself. The layer is
+    looked up in the graph index of the model in models_dir.
+    """
+    layer_name_safe = variant_layer_name(attention_variant, layer_index, models_dir, model_num).replace('/', '_')
+    num_heads = num_attention_heads(layer_index, models_dir, model_num)
+
+    attention_dir = os.path.join(bin_dir, layer_name_safe, 'attention')
+    os.makedirs(attention_dir, exist_ok=True)
+    if attention_top_k is not None or attention_mass is not None:
+        if attention_format != 'packed' or attention_dtype not in SPARSE_DTYPES:
+            raise ValueError(f"Sparse attention requires the packed attention format and one of {', '.join(SPARSE_DTYPES)}.")
+        max_dropped = save_attention_sparse(attention_output if attention_scores is None else attention_scores, attention_dir, num_heads,
+                                            top_k=attention_top_k, mass=attention_mass, dtype=attention_dtype, mask=attention_mask,
+                                            verbose=verbose)
+        print(f"Attention {layer_name_safe}: sparse, max dropped mass per query {max_dropped:.3g}")
+    elif attention_format == 'packed':
+        max_error = save_attention_packed(attention_output, attention_dir, num_heads, dtype=attention_dtype, verbose=verbose)
+        if attention_dtype != 'float32':
+            print(f"Attention {layer_name_safe}: {attention_dtype} max reconstruction error {max_error:.3g}")
+    elif attention_dtype != 'float32':
+        raise ValueError(f"Attention dtype {attention_dtype} requires the packed attention format.")
+    else:
+        save_attention_files(attention_output, attention_dir, num_heads, verbose=verbose)
+
+def load_manifest(bin_dir):
+    """Load the manifest of a formatted timestep, recording the source and options each output was written from."""
+    manifest_path = os.path.join(bin_dir, MANIFEST_NAME)
+    manifest = {'maps': {}, 'layers': {}, 'stats': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest.update(json.load(manifest_file))
+    return manifest
+
+def update_manifest(bin_dir, manifest, group, name, entry):
+    """Set one output of the manifest, or remove it if entry is None, and save the manifest atomically."""
+    if entry is None:
+        manifest[group].pop(name, None)
+    else:
+        manifest[group][name] = entry
+    write_json_atomic(os.path.join(bin_dir, MANIFEST_NAME), manifest)
+
+def is_stale(entry, source, options=None):
+    """Return True if an output is missing, or was written from another source or with other options.
+
+    Outputs with an unknown source are always stale.
+    """
+    return entry is None or source is None or entry['source'] != source or entry.get('options') != options
+
+def format_arrays(src_dir, data_date, data_time, input_upper, input_surface, attention_outputs, attention_format='packed',
+                  attention_dtype='float32', attention_top_k=None, attention_mass=None, attention_variant='post_bias', source_variants=None,
+                  models_dir='checkpoints', model_num=24, sources=None, force=False, stats=True, verbose=False):
+    """Format in-memory inputs and attention outputs, given as {layer index: array}, into binaries for the web app.
+
+    The attention is written as attention_variant, derived window by window from the variant each output holds,
+    given by source_variants as {layer index: variant} and by default the variant exported for attention_variant.
+    The positional bias and shift masks this may need are read from the model in models_dir. Only missing or
+    stale outputs are written. sources holds fingerprints of the data each output is formatted from,
+    keyed by input name or layer index, and outputs without one are always written. Each output is dropped from
+    the manifest of the timestep while it is written, so an interrupted run rewrites it. With force the timestep is
+    cleared and every output is written. Without stats, for outputs that are not attention scores such as variances,
+    no statistics are written and any earlier ones are removed.
+    """
+    bin_dir = os.path.join(src_dir, 'bin', data_date, data_time)
+    if force:
+        clear_directory(bin_dir, verbose=verbose)
+    os.makedirs(bin_dir, exist_ok=True)
+    manifest = load_manifest(bin_dir)
+    sources = sources or {}
+
+    for data_type, input_data in (('input_surface', input_surface[:, np.newaxis]), ('input_upper', input_upper)):
+        if not is_stale(manifest['maps'].get(data_type), sources.get(data_type)):
             if verbose:
-                print(f"Saved chunk: {chunk_filename}")
+                print(f"Map data up to date: {data_type}")
+            continue
+        update_manifest(bin_dir, manifest, 'maps', data_type, None)
+        save_map_data(input_data, bin_dir, data_type, upper=data_type == 'input_upper', chunk_sizes=map_chunk_sizes(models_dir, model_num),
+                      verbose=verbose)
+        update_manifest(bin_dir, manifest, 'maps', data_type, {'source': sources.get(data_type)})
 
-def main(args):
-    # Clear the bin directory before processing
-    bin_dir = os.path.join(args.src_dir, 'bin', args.data_date, args.data_time)
-    clear_directory(bin_dir, verbose=args.verbose)
-
-    input_surface_path = os.path.join(args.input_data_dir, args.data_date, args.data_time, f"{args.input_surface_name.replace('/', '_')}.npy")
-    input_surface = np.load(input_surface_path)
-
-    save_map_data(input_surface, 24, 48, 'config_24x48', 'input_surface', verbose=args.verbose)
-    save_map_data(input_surface, 48, 96, 'config_48x96', 'input_surface', verbose=args.verbose)
-    save_map_data(input_surface, 24, 48, 'config_24x48_shifted', 'input_surface', roll_data=True, verbose=args.verbose)
-    save_map_data(input_surface, 48, 96, 'config_48x96_shifted', 'input_surface', roll_data=True, verbose=args.verbose)
-
-    input_upper_path = os.path.join(args.input_data_dir, args.data_date, args.data_time, f"{args.input_upper_name.replace('/', '_')}.npy")
-    input_upper = np.load(input_upper_path)
-
-    for i in trange(input_upper.shape[1], desc="Processing upper data chunks", disable=not args.verbose):
-        upper_data_chunk = input_upper[:, i, :, :]
-        save_map_data(upper_data_chunk, 24, 48, f'config_24x48_upper_{i}', 'input_upper', verbose=args.verbose)
-        save_map_data(upper_data_chunk, 48, 96, f'config_48x96_upper_{i}', 'input_upper', verbose=args.verbose)
-        save_map_data(upper_data_chunk, 24, 48, f'config_24x48_upper_{i}_shifted', 'input_upper', roll_data=True, verbose=args.verbose)
-        save_map_data(upper_data_chunk, 48, 96, f'config_48x96_upper_{i}_shifted', 'input_upper', roll_data=True, verbose=args.verbose)
-
-    for layer_index in tqdm(args.intermediate_layers, desc="Processing intermediate layers", disable=not args.verbose):
-        if layer_index < 0 or layer_index >= len(INTERMEDIATE_LAYER_NAMES):
+    options = {'attention_format': attention_format, 'attention_dtype': attention_dtype,
+               'attention_top_k': attention_top_k, 'attention_mass': attention_mass}
+    for layer_index, attention_output in tqdm(attention_outputs.items(), desc="Processing intermediate layers", disable=not verbose):
+        layer_name_safe = variant_layer_name(attention_variant, layer_index, models_dir, model_num).replace('/', '_')
+        source = sources.get(layer_index)
+        layer_stale = is_stale(manifest['layers'].get(layer_name_safe), source, options)
+        stats_stale = stats and (layer_stale or is_stale(manifest['stats'].get(layer_name_safe), source))
+        if layer_stale or stats_stale:
+            source_variant = (source_variants or {}).get(layer_index, EXPORTED_VARIANTS[attention_variant])
+            view_options = {'models_dir': models_dir, 'model_num': model_num}
+            attention_values = attention_view(attention_output, source_variant, attention_variant, layer_index, **view_options)
+            # Sparse weights and statistics use the softmax of the model whichever variant is shown.
+            sparse = attention_top_k is not None or attention_mass is not None
+            attention_scores, attention_mask = (softmax_scores(attention_output, source_variant, layer_index, **view_options)
+                                                if sparse or stats_stale else (None, None))
+        if layer_stale:
+            update_manifest(bin_dir, manifest, 'stats', layer_name_safe, None)
+            update_manifest(bin_dir, manifest, 'layers', layer_name_safe, None)
+            shutil.rmtree(os.path.join(bin_dir, layer_name_safe), ignore_errors=True)
+            format_attention(bin_dir, layer_index, attention_values, attention_format=attention_format,
+                             attention_dtype=attention_dtype, attention_top_k=attention_top_k, attention_mass=attention_mass,
+                             attention_variant=attention_variant, attention_scores=attention_scores,
+                             attention_mask=attention_mask, models_dir=models_dir, model_num=model_num, verbose=verbose)
+            update_manifest(bin_dir, manifest, 'layers', layer_name_safe, {'source': source, 'options': options})
+        # The statistics are tracked separately so they can be added to layers formatted without them.
+        if stats_stale:
+            save_attention_stats(attention_scores, os.path.join(bin_dir, layer_name_safe),
+                                 num_attention_heads(layer_index, models_dir, model_num), mask=attention_mask, verbose=verbose)
+            update_manifest(bin_dir, manifest, 'stats', layer_name_safe, {'source': source})
+        elif not stats and layer_name_safe in manifest['stats']:
+            remove_attention_stats(os.path.join(bin_dir, layer_name_safe), verbose=verbose)
+            update_manifest(bin_dir, manifest, 'stats', layer_name_safe, None)
+        elif not layer_stale and verbose:
+            print(f"Attention data up to date: {layer_name_safe}")
+
+    update_available_data(src_dir, data_date, data_time, verbose=verbose)
+
+def format_timestep(src_dir, input_data_dir, output_data_dir, data_date, data_time, intermediate_layers,
+                    input_surface_name='input_surface', input_upper_name='input_upper', attention_format='packed',
+                    attention_dtype='float32', attention_top_k=None, attention_mass=None, attention_variant='post_bias',
+                    models_dir='checkpoints', model_num=24, force=False, stats=True, verbose=False):
+    """Format the inputs and attention outputs of a single timestep into binaries for the web app.
+
+    Each layer is read from the saved activations of attention_variant if there are any, and otherwise derived
+    from the activations of another variant. Outputs already formatted from the same source files with the same
+    options are skipped. stats is passed on to format_arrays.
+    """
+    input_names = [input_upper_name, input_surface_name]
+    input_upper, input_surface = load_inputs(input_data_dir, data_date, data_time, names=input_names, mmap_mode='r')
+    sources = dict(zip(INPUT_NAMES, input_sources(input_data_dir, data_date, data_time, names=input_names)))
+
+    attention_outputs, source_variants = {}, {}
+    candidate_variants = list(dict.fromkeys([attention_variant, EXPORTED_VARIANTS[attention_variant], 'post_bias', 'pre_bias']))
+    for layer_index in intermediate_layers:
+        if layer_index < 0 or layer_index >= len(attention_layers(models_dir, model_num)):
             print(f"Invalid layer index: {layer_index}. Skipping.")
             continue
 
-        layer_name = INTERMEDIATE_LAYER_NAMES[layer_index]
-        layer_name_safe = layer_name.replace('/', '_')
-        attention_path = os.path.join(args.output_data_dir, args.data_date, args.data_time, f"{layer_name_safe}.npy")
-        
-        if not os.path.exists(attention_path):
+        for source_variant in candidate_variants:
+            layer_name_safe = variant_layer_name(source_variant, layer_index, models_dir, model_num).replace('/', '_')
+            attention_path = os.path.join(output_data_dir, data_date, data_time, f"{layer_name_safe}.npy")
+            if os.path.exists(attention_path):
+                break
+        else:
+            layer_name_safe = variant_layer_name(attention_variant, layer_index, models_dir, model_num).replace('/', '_')
             print(f"Attention data not found for layer: {layer_name_safe}. Skipping.")
             continue
 
-        attention_output = np.load(attention_path)
+        # Memory-map the activations so they are read window by window while formatting.
+        attention_outputs[layer_index] = np.load(attention_path, mmap_mode='r')
+        source_variants[layer_index] = source_variant
+        sources[layer_index] = file_fingerprint(attention_path)
 
-        num_heads = 6 if layer_index < 2 or layer_index >= len(INTERMEDIATE_LAYER_NAMES) - 2 else 12
+    format_arrays(src_dir, data_date, data_time, input_upper, input_surface, attention_outputs,
+                  attention_format=attention_format, attention_dtype=attention_dtype, attention_top_k=attention_top_k,
+                  attention_mass=attention_mass, attention_variant=attention_variant, source_variants=source_variants,
+                  models_dir=models_dir, model_num=model_num, sources=sources, force=force, stats=stats, verbose=verbose)
 
-        for lon in range(attention_output.shape[0]):
-            for lat_pl in range(attention_output.shape[1]):
-                for head in range(num_heads):
-                    attention_chunk = attention_output[lon, lat_pl, head, :, :]
-                    attention_dir = os.path.join(args.src_dir, 'bin', args.data_date, args.data_time, layer_name_safe, 'attention')
-                    os.makedirs(attention_dir, exist_ok=True)
-                    attention_filename = f"attention_{lon}_{lat_pl}_{head}.bin"
-                    attention_chunk.tofile(os.path.join(attention_dir, attention_filename))
-                    if args.verbose:
-                        print(f"Saved attention chunk: {attention_filename}")
+def list_layers(time_path):
+    """Attention layer directories of a formatted timestep."""
+    return sorted(layer for layer in os.listdir(time_path)
+                  if os.path.isdir(os.path.join(time_path, layer)) and 'config' not in layer)
+
+@contextmanager
+def available_data_lock(src_dir):
+    """Hold an exclusive lock on the available data index while it is read and rewritten."""
+    with open(os.path.join(src_dir, f".{AVAILABLE_DATA_NAME}.lock"), 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def update_available_data(src_dir, data_date, data_time, verbose=False):
+    """Record the layers of one formatted timestep in the index read by the web app, without rescanning the bin tree.
+
+    The index is replaced atomically under a lock, so concurrent workers can update it.
+    """
+    json_path = os.path.join(src_dir, AVAILABLE_DATA_NAME)
+    with available_data_lock(src_dir):
+        available_data = {}
+        if os.path.exists(json_path):
+            with open(json_path) as json_file:
+                available_data = json.load(json_file)
+        times = available_data.get(data_date, {})
+        times[data_time] = list_layers(os.path.join(src_dir, 'bin', data_date, data_time))
+        available_data[data_date] = dict(sorted(times.items()))
+        write_json_atomic(json_path, dict(sorted(available_data.items())))
+    if verbose:
+        print(f"Updated available data for {data_date} {data_time}: {json_path}")
 
+def save_available_data(src_dir, verbose=False):
+    """Rebuild the index of formatted dates, times and layers read by the web app from the whole bin tree."""
     available_data = {}
-    for date in os.listdir(os.path.join(args.src_dir, 'bin')):
-        date_path = os.path.join(args.src_dir, 'bin', date)
+    bin_dir = os.path.join(src_dir, 'bin')
+    for date in sorted(os.listdir(bin_dir)):
+        date_path = os.path.join(bin_dir, date)
         if os.path.isdir(date_path):
             available_data[date] = {}
-            for time in os.listdir(date_path):
+            for time in sorted(os.listdir(date_path)):
                 time_path = os.path.join(date_path, time)
                 if os.path.isdir(time_path):
-                    available_data[date][time] = []
-                    for layer in os.listdir(time_path):
-                        layer_path = os.path.join(time_path, layer)
-                        if os.path.isdir(layer_path) and 'config' not in layer:
-                            available_data[date][time].append(layer)
-
-    json_dir = os.path.join(args.src_dir, 'available_data.json')
-    with open(json_dir, 'w') as json_file:
-        json.dump(available_data, json_file, indent=4)
-    if args.verbose:
+                    available_data[date][time] = list_layers(time_path)
+
+    json_dir = os.path.join(src_dir, AVAILABLE_DATA_NAME)
+    with available_data_lock(src_dir):
+        write_json_atomic(json_dir, available_data)
+    if verbose:
         print(f"Saved available data to {json_dir}")
 
+def print_attention_dtype_comparison(output_data_dir, data_date, data_time, intermediate_layers, models_dir='checkpoints', model_num=None):
+    """Print the storage size and reconstruction error of every attention dtype for the requested layers."""
+    print(f"{'Layer':<24}{'Dtype':<10}{'Bytes/slice':>12}{'Max error':>12}")
+    for layer_index in intermediate_layers:
+        layer_name_safe = variant_layer_name('post_bias', layer_index, models_dir, model_num).replace('/', '_')
+        attention_path = os.path.join(output_data_dir, data_date, data_time, f"{layer_name_safe}.npy")
+        if not os.path.exists(attention_path):
+            print(f"Attention data not found for layer: {layer_name_safe}. Skipping.")
+            continue
+        num_heads = num_attention_heads(layer_index, models_dir, model_num)
+        comparison = compare_attention_dtypes(np.load(attention_path, mmap_mode='r'), num_heads)
+        for dtype, (slice_bytes, max_error) in comparison.items():
+            print(f"{layer_name_safe:<24}{dtype:<10}{slice_bytes:>12}{max_error:>12.3g}")
+
+def main(args):
+    if args.attention_dtype != 'float32' and args.attention_format != 'packed':
+        raise SystemExit("--attention_dtype requires --attention_format packed")
+    if args.attention_top_k is not None or args.attention_mass is not None:
+        if args.attention_format != 'packed' or args.attention_dtype not in SPARSE_DTYPES:
+            raise SystemExit(f"Sparse attention requires --attention_format packed and --attention_dtype {' or '.join(SPARSE_DTYPES)}")
+        if (args.attention_top_k is not None and args.attention_top_k < 1) or (args.attention_mass is not None and not 0 < args.attention_mass <= 1):
+            raise SystemExit("--attention_top_k must be at least 1 and --attention_mass in (0, 1]")
+    if args.compare_attention_dtypes:
+        print_attention_dtype_comparison(args.output_data_dir, args.data_date, args.data_time, args.intermediate_layers,
+                                         models_dir=args.models_dir, model_num=args.model_num)
+        return
+
+    format_timestep(args.src_dir, args.input_data_dir, args.output_data_dir, args.data_date, args.data_time, args.intermediate_layers,
+                    input_surface_name=args.input_surface_name, input_upper_name=args.input_upper_name,
+                    attention_format=args.attention_format, attention_dtype=args.attention_dtype,
+                    attention_top_k=args.attention_top_k, attention_mass=args.attention_mass, attention_variant=args.attention_variant,
+                    models_dir=args.models_dir, model_num=args.model_num, force=args.force, verbose=args.verbose)
+    if args.rebuild_available_data:
+        save_available_data(args.src_dir, verbose=args.verbose)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process ONNX model outputs and save map data.')
     parser.add_argument('--data_date', type=str, required=True, help='Date of the data in YYYY-MM-DD format.')
@@ -132,6 +633,17 @@ if __name__ == "__main__":
     parser.add_argument('--src_dir', type=str, default='src', help='Directory for binary output.')
     parser.add_argument('--input_surface_name', type=str, default='input_surface', help='Name of the input surface file.')
     parser.add_argument('--input_upper_name', type=str, default='input_upper', help='Name of the input upper file.')
+    parser.add_argument('--attention_format', choices=['packed', 'files'], default='packed', help='Write each attention layer as one packed file or one file per window and head.')
+    parser.add_argument('--attention_dtype', choices=ATTENTION_DTYPES, default='float32', help='Storage type of the packed attention, the integer types are quantised per tile.')
+    sparse_group = parser.add_mutually_exclusive_group()
+    sparse_group.add_argument('--attention_top_k', type=int, help='Store only the top k softmax weights of each query.')
+    sparse_group.add_argument('--attention_mass', type=float, help='Store only the largest softmax weights of each query that add up to this mass.')
+    parser.add_argument('--attention_variant', choices=ATTENTION_VARIANTS, default='post_bias', help='Attention to show: the scores before or after the positional bias, or the softmax weights.')
+    parser.add_argument('--models_dir', type=str, default='checkpoints', help='Directory of the model, read for the positional bias when a variant is derived and for the shift masks of shifted layers.')
+    parser.add_argument('--model_num', type=int, default=24, help='Model the activations were saved from.')
+    parser.add_argument('--force', action='store_true', help='Clear the timestep and format every output, even those that are up to date.')
+    parser.add_argument('--rebuild_available_data', action='store_true', help='Rebuild available_data.json from the whole bin tree.')
+    parser.add_argument('--compare_attention_dtypes', action='store_true', help='Report the size and reconstruction error of every attention dtype without formatting.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
 
     args = parser.parse_args()
@@ -0,0 +1,133 @@
+import os
+import json
+import glob
+import argparse
+from functools import lru_cache
+from math import ceil
+import onnx
+from model_cache import write_json_atomic
+from constants import (ATTENTION_LAYER_NAMES, PRE_EARTH_POS_BIAS_ATTENTION_LAYER_NAMES, POST_SOFTMAX_ATTENTION_LAYER_NAMES,
+                       WIN_SHIFT_ATTENTION_LAYER_INDEXES, UP_SAMPLE_ATTENTION_LAYER_INDEXES)
+
+INDEX_VERSION = 1
+# Pangu embeds 4x4 pixel patches in its first stage and merges them 2x2 in the second, and every window
+# holds 2 x 6 x 12 patches along pressure level, lat and lon.
+PATCH_SIZE = 4
+WINDOW_SHAPE = (2, 6, 12)
+INPUT_HEIGHT = 721
+LAYERS_NAME = 'layers.json'
+
+def index_path(models_dir, model_num):
+    """Path of the graph index sidecar of a model."""
+    return os.path.join(models_dir, f'pangu_weather_{model_num}.json')
+
+def window_config(patch_size, input_height=INPUT_HEIGHT):
+    """Map chunk size, config name and number of lat windows per pressure level of a stage with the given patch size."""
+    chunk_size = [WINDOW_SHAPE[1] * patch_size, WINDOW_SHAPE[2] * patch_size]
+    return {'patch_size': patch_size, 'chunk_size': chunk_size, 'config_name': f'config_{chunk_size[0]}x{chunk_size[1]}',
+            'lat_windows': ceil(ceil(input_height / patch_size) / WINDOW_SHAPE[1])}
+
+def trace_layers(graph):
+    """Find every attention layer of a graph, in graph order, from its softmax back to the query-key MatMul.
+
+    Each layer is a MatMul, an Add of the positional bias, any Adds of shift masks and a Softmax. Returns the
+    tensor names of each layer with its bias and mask tensors.
+    """
+    producers = {output: node for node in graph.node for output in node.output}
+    layers = []
+    for node in graph.node:
+        if node.op_type != 'Softmax':
+            continue
+        tensor, masks = node.input[0], []
+        while tensor in producers and producers[tensor].op_type == 'Add':
+            add = producers[tensor]
+            scores = [name for name in add.input if name in producers and producers[name].op_type == 'MatMul']
+            if scores:
+                layers.append({'pre_bias': scores[0], 'post_bias': tensor, 'post_softmax': node.output[0],
+                               'bias': next(name for name in add.input if name != scores[0]), 'masks': masks[::-1]})
+                break
+            chained = [name for name in add.input if name in producers and producers[name].op_type in ('Add', 'MatMul')]
+            if not chained:
+                break
+            masks.append(next(name for name in add.input if name != chained[0]))
+            tensor = chained[0]
+    return layers
+
+def build_index(model_path, verbose=False):
+    """Scan a model for its attention layers and describe their names, shapes, heads, window configs and shifts."""
+    model = onnx.shape_inference.infer_shapes(onnx.load(model_path))
+    shapes = {value.name: [dim.dim_value for dim in value.type.tensor_type.shape.dim]
+              for value in list(model.graph.value_info) + list(model.graph.input)}
+    input_height = (shapes.get('input') or [INPUT_HEIGHT] * 2)[-2]
+    layers = [layer for layer in trace_layers(model.graph) if len(shapes.get(layer['post_bias'], [])) == 5]
+    max_lon_windows = max(shapes[layer['post_bias']][0] for layer in layers)
+    for layer_index, layer in enumerate(layers):
+        shape = shapes[layer['post_bias']]
+        patch_size = PATCH_SIZE * max_lon_windows // shape[0]
+        layer.update({'index': layer_index, 'shape': shape, 'num_heads': shape[2], 'shifted': bool(layer['masks']),
+                      **window_config(patch_size, input_height)})
+        if verbose:
+            print(f"Layer {layer_index}: {layer['post_bias']} {shape} {layer['config_name']}{' shifted' if layer['shifted'] else ''}")
+    stat = os.stat(model_path)
+    return {'version': INDEX_VERSION, 'model': os.path.basename(model_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'input_height': input_height, 'layers': layers}
+
+def default_layers():
+    """Attention layers described from constants.py, for when no model has been indexed."""
+    layers = []
+    for layer_index, name in enumerate(ATTENTION_LAYER_NAMES):
+        up_sample = layer_index in UP_SAMPLE_ATTENTION_LAYER_INDEXES
+        layers.append({'index': layer_index, 'pre_bias': PRE_EARTH_POS_BIAS_ATTENTION_LAYER_NAMES[layer_index], 'post_bias': name,
+                       'post_softmax': POST_SOFTMAX_ATTENTION_LAYER_NAMES[layer_index], 'num_heads': 6 if up_sample else 12,
+                       'shifted': layer_index in WIN_SHIFT_ATTENTION_LAYER_INDEXES,
+                       **window_config(PATCH_SIZE if up_sample else 2 * PATCH_SIZE)})
+    return layers
+
+@lru_cache(maxsize=None)
+def load_index(models_dir='checkpoints', model_num=None):
+    """Load the graph index of a model, or of any indexed model if model_num is None. Returns None if there is none.
+
+    An index is ignored once its model has changed or is missing. Every Pangu model shares the same attention layers.
+    """
+    paths = ([index_path(models_dir, model_num)] if model_num is not None else
+             sorted(path for path in glob.glob(index_path(models_dir, '*')) if os.path.basename(path)[len('pangu_weather_'):-len('.json')].isdigit()))
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as index_file:
+            index = json.load(index_file)
+        model_path = os.path.join(models_dir, index.get('model', ''))
+        if index.get('version') != INDEX_VERSION:
+            continue
+        if not os.path.isfile(model_path) or [os.path.getsize(model_path), os.stat(model_path).st_mtime_ns] != [index['size'], index['mtime_ns']]:
+            continue
+        return index
+    return None
+
+def attention_layers(models_dir='checkpoints', model_num=None):
+    """Attention layers from the graph index, falling back to constants.py."""
+    index = load_index(models_dir, model_num)
+    return index['layers'] if index is not None else default_layers()
+
+def main(args):
+    model_paths = ([os.path.join(args.models_dir, f'pangu_weather_{args.model_num}.onnx')] if args.model_num is not None
+                   else sorted(glob.glob(os.path.join(args.models_dir, 'pangu_weather_*.onnx'))))
+    for model_path in model_paths:
+        model_num = os.path.basename(model_path)[len('pangu_weather_'):-len('.onnx')]
+        if not model_num.isdigit():
+            continue
+        index = build_index(model_path, verbose=args.verbose)
+        write_json_atomic(index_path(args.models_dir, model_num), index)
+        print(f"Indexed {len(index['layers'])} attention layers: {index_path(args.models_dir, model_num)}")
+        if args.src_dir is not None:
+            write_json_atomic(os.path.join(args.src_dir, LAYERS_NAME), {'layers': index['layers']})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Index the attention layers of the models into small sidecar files read by the scripts and the web app.')
+    parser.add_argument('--models_dir', type=str, default='checkpoints', help='Directory for model checkpoints.')
+    parser.add_argument('--model_num', type=int, help='Model to index, by default every model in the directory.')
+    parser.add_argument('--src_dir', type=str, default='src', help='Directory of the web app to write layers.json to.')
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,174 @@
+import os
+import json
+import argparse
+from time import time_ns
+import numpy as np
+from tqdm import tqdm
+from model_cache import write_json_atomic
+
+STORE_DIR_NAME = 'store'
+STORE_INDEX_NAME = 'index.json'
+STORE_DTYPE = np.float32
+INPUT_NAMES = ['input_upper', 'input_surface']
+
+class InputStore:
+    """Append-only store of model inputs, holding one raw float32 file per input and an index from timestep to record.
+
+    Timesteps are returned as read-only views of memory-mapped files, so they can be handed to the model or
+    tiled without copying. A single writer may append while other processes read.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self._maps = {}
+        self.refresh()
+
+    @staticmethod
+    def key(data_date, data_time):
+        return f"{data_date} {data_time}"
+
+    def refresh(self):
+        """Reload the index, picking up timesteps appended by another process."""
+        self.index = {'dtype': np.dtype(STORE_DTYPE).name, 'shapes': {}, 'records': {}, 'written': {}}
+        index_path = os.path.join(self.store_dir, STORE_INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path) as index_file:
+                self.index = json.load(index_file)
+
+    def __contains__(self, timestep):
+        return self.key(*timestep) in self.index['records']
+
+    def __len__(self):
+        return len(self.index['records'])
+
+    def timesteps(self):
+        """Stored timesteps as sorted (date, time) pairs."""
+        return sorted(tuple(key.split(' ')) for key in self.index['records'])
+
+    def _path(self, name):
+        return os.path.join(self.store_dir, f"{name}.dat")
+
+    def _record_bytes(self, name):
+        return int(np.prod(self.index['shapes'][name])) * np.dtype(STORE_DTYPE).itemsize
+
+    def _map(self, name):
+        """Memory-map an input file, remapping it once records have been appended."""
+        num_records = len(self.index['records'])
+        mapped = self._maps.get(name)
+        if mapped is None or len(mapped) < num_records:
+            shape = (num_records,) + tuple(self.index['shapes'][name])
+            mapped = self._maps[name] = np.memmap(self._path(name), dtype=STORE_DTYPE, mode='r', shape=shape)
+        return mapped
+
+    def written(self, data_date, data_time):
+        """Time in nanoseconds at which a timestep was last written, or None if unknown."""
+        return self.index.get('written', {}).get(self.key(data_date, data_time))
+
+    def load(self, data_date, data_time):
+        """Return read-only views of the upper and surface inputs of a timestep."""
+        record = self.index['records'][self.key(data_date, data_time)]
+        return tuple(self._map(name)[record] for name in INPUT_NAMES)
+
+    def append(self, data_date, data_time, input_upper, input_surface):
+        """Add a timestep, overwriting it in place if it is already stored.
+
+        The data is written before the index, so an interrupted append leaves the store unchanged and
+        its partial record is overwritten by the next append.
+        """
+        arrays = dict(zip(INPUT_NAMES, (input_upper, input_surface)))
+        if not self.index['shapes']:
+            self.index['shapes'] = {name: [int(dim) for dim in array.shape] for name, array in arrays.items()}
+        for name, array in arrays.items():
+            if list(array.shape) != self.index['shapes'][name]:
+                raise ValueError(f"Shape {array.shape} of {name} does not match the store shape {tuple(self.index['shapes'][name])}")
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        key = self.key(data_date, data_time)
+        record = self.index['records'].get(key, len(self.index['records']))
+        for name, array in arrays.items():
+            record_bytes = self._record_bytes(name)
+            with open(self._path(name), 'r+b' if os.path.exists(self._path(name)) else 'w+b') as data_file:
+                if record == len(self.index['records']):
+                    data_file.truncate(record * record_bytes)
+                data_file.seek(record * record_bytes)
+                data_file.write(np.ascontiguousarray(array, dtype=STORE_DTYPE).tobytes())
+        self.index['records'][key] = record
+        self.index.setdefault('written', {})[key] = time_ns()
+        write_json_atomic(os.path.join(self.store_dir, STORE_INDEX_NAME), self.index)
+
+_stores = {}
+
+def open_store(input_data_dir):
+    """Return the input store of a data directory, or None if it has none. Stores are reused between calls."""
+    store_dir = os.path.join(input_data_dir, STORE_DIR_NAME)
+    if store_dir not in _stores:
+        if not os.path.exists(os.path.join(store_dir, STORE_INDEX_NAME)):
+            return None
+        _stores[store_dir] = InputStore(store_dir)
+    return _stores[store_dir]
+
+def find_stored(input_data_dir, data_date, data_time, names=INPUT_NAMES):
+    """Return the input store if it holds the given inputs of a timestep, or None if they are read from .npy files."""
+    store = open_store(input_data_dir) if list(names) == INPUT_NAMES else None
+    if store is not None and (data_date, data_time) not in store:
+        store.refresh()
+    return store if store is not None and (data_date, data_time) in store else None
+
+def load_inputs(input_data_dir, data_date, data_time, names=INPUT_NAMES, mmap_mode=None):
+    """Load the upper and surface inputs of a timestep, from the input store if it holds the timestep.
+
+    Otherwise the inputs are loaded from their .npy files, memory-mapped if mmap_mode is given.
+    """
+    store = find_stored(input_data_dir, data_date, data_time, names)
+    if store is not None:
+        return store.load(data_date, data_time)
+    return tuple(np.load(os.path.join(input_data_dir, data_date, data_time, f"{name.replace('/', '_')}.npy"), mmap_mode=mmap_mode)
+                 for name in names)
+
+def file_fingerprint(path):
+    """Size and modification time of a file, used to tell whether outputs formatted from it are stale."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def input_sources(input_data_dir, data_date, data_time, names=INPUT_NAMES):
+    """Fingerprints of the inputs of a timestep, in the order of names, from wherever load_inputs reads them.
+
+    A fingerprint is None if it is unknown.
+    """
+    store = find_stored(input_data_dir, data_date, data_time, names)
+    if store is not None:
+        written = store.written(data_date, data_time)
+        return [None if written is None else ['store', written] for _ in names]
+    return [file_fingerprint(os.path.join(input_data_dir, data_date, data_time, f"{name.replace('/', '_')}.npy")) for name in names]
+
+def find_npy_timesteps(input_data_dir):
+    """Timesteps of the input data directory that have both .npy inputs, as sorted (date, time) pairs."""
+    timesteps = []
+    for data_date in sorted(os.listdir(input_data_dir)):
+        date_path = os.path.join(input_data_dir, data_date)
+        if data_date == STORE_DIR_NAME or not os.path.isdir(date_path):
+            continue
+        for data_time in sorted(os.listdir(date_path)):
+            if all(os.path.exists(os.path.join(date_path, data_time, f"{name}.npy")) for name in INPUT_NAMES):
+                timesteps.append((data_date, data_time))
+    return timesteps
+
+def main(args):
+    store = InputStore(os.path.join(args.input_data_dir, STORE_DIR_NAME))
+    timesteps = [timestep for timestep in find_npy_timesteps(args.input_data_dir) if args.overwrite or timestep not in store]
+    for data_date, data_time in tqdm(timesteps, desc="Storing timesteps"):
+        input_dir = os.path.join(args.input_data_dir, data_date, data_time)
+        store.append(data_date, data_time, *(np.load(os.path.join(input_dir, f"{name}.npy"), mmap_mode='r') for name in INPUT_NAMES))
+        if args.remove_npy:
+            for name in INPUT_NAMES:
+                os.remove(os.path.join(input_dir, f"{name}.npy"))
+    print(f"Input store holds {len(store)} timesteps: {store.store_dir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Add the .npy inputs of every downloaded timestep to the memory-mapped input store.')
+    parser.add_argument('--input_data_dir', type=str, default='input_data', help='Directory for input data.')
+    parser.add_argument('--overwrite', action='store_true', help='Rewrite timesteps that are already stored.')
+    parser.add_argument('--remove_npy', action='store_true', help='Remove the .npy files once their timestep is stored.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+import tempfile
+
+CACHE_DIR_NAME = 'cache'
+OPTIMIZED_SUFFIX = '.optimized.onnx'
+HASH_CHUNK_SIZE = 64 * 1024 * 1024
+
+def hash_model(model_path):
+    """Return the SHA-256 of a model file, reusing a sidecar record while the file is unchanged."""
+    stat = os.stat(model_path)
+    sidecar_path = f"{model_path}.sha256.json"
+    if os.path.exists(sidecar_path):
+        with open(sidecar_path) as sidecar_file:
+            record = json.load(sidecar_file)
+        if record.get('size') == stat.st_size and record.get('mtime') == stat.st_mtime:
+            return record['sha256']
+
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as model_file:
+        for block in iter(lambda: model_file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(block)
+    record = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest.hexdigest()}
+    write_json_atomic(sidecar_path, record)
+    return record['sha256']
+
+def cache_key(model_hash, model_num, layer_names, **options):
+    """Build the cache key for a modified model from its source hash, model number and layer set."""
+    config = {'model_hash': model_hash, 'model_num': model_num, 'layers': sorted(layer_names), **options}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+def cached_model_path(models_dir, model_num, key):
+    """Path of the cached modified model for a key."""
+    return os.path.join(models_dir, CACHE_DIR_NAME, f'pangu_weather_{model_num}_{key}.onnx')
+
+def optimized_model_path(path):
+    """Path of the graph optimised by ONNX Runtime for a cached model."""
+    return f"{os.path.splitext(path)[0]}{OPTIMIZED_SUFFIX}"
+
+def lookup(path):
+    """Return True if the cached model exists, marking it as recently used."""
+    if not os.path.exists(path):
+        return False
+    os.utime(path)
+    return True
+
+def store(path, save_fn):
+    """Write a cache entry through a temporary file so concurrent runs never see a partial model."""
+    cache_dir = os.path.dirname(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.onnx.tmp')
+    os.close(fd)
+    try:
+        save_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def evict(models_dir, max_entries, keep=(), verbose=False):
+    """Remove the least recently used cached models beyond max_entries, never removing those in keep."""
+    cache_dir = os.path.join(models_dir, CACHE_DIR_NAME)
+    if not os.path.isdir(cache_dir):
+        return
+    entries = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+               if name.endswith('.onnx') and not name.endswith(OPTIMIZED_SUFFIX)]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    keep = {os.path.abspath(path) for path in keep}
+    for path in entries[max_entries:]:
+        if os.path.abspath(path) in keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        if os.path.exists(optimized_model_path(path)):
+            os.remove(optimized_model_path(path))
+        if verbose:
+            print(f"Evicted cached model: {os.path.basename(path)}")
+
+def write_json_atomic(path, data):
+    """Write a JSON file through a temporary file and an atomic rename."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.json.tmp')
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(data, tmp_file, indent=4)
+    # mkstemp creates the file readable by its owner only.
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
@@ -0,0 +1,64 @@
+import os
+import re
+import numpy as np
+import argparse
+from tqdm import tqdm
+from format_data import ATTENTION_PACKED_NAME, save_attention_index
+
+ATTENTION_FILE_PATTERN = re.compile(r'attention_(\d+)_(\d+)_(\d+)\.bin$')
+ATTENTION_WINDOW_SIZE = 144
+
+def find_attention_dirs(bin_dir):
+    """Find every layer attention directory that still holds one file per window and head."""
+    attention_dirs = []
+    for root, _, files in os.walk(bin_dir):
+        if os.path.basename(root) == 'attention' and any(ATTENTION_FILE_PATTERN.match(name) for name in files):
+            attention_dirs.append(root)
+    return sorted(attention_dirs)
+
+def pack_attention_dir(attention_dir, keep_files=False, verbose=False):
+    """Pack the per-window files of one attention directory into a single file with an index.
+
+    Returns False, leaving the directory untouched, if some windows or heads are missing.
+    """
+    indices = {}
+    for name in os.listdir(attention_dir):
+        match = ATTENTION_FILE_PATTERN.match(name)
+        if match:
+            indices[tuple(int(group) for group in match.groups())] = name
+
+    shape = tuple(max(index[axis] for index in indices) + 1 for axis in range(3))
+    if len(indices) != shape[0] * shape[1] * shape[2]:
+        print(f"Incomplete attention directory, {len(indices)} of {shape[0] * shape[1] * shape[2]} files: {attention_dir}. Skipping.")
+        return False
+
+    packed_path = os.path.join(attention_dir, ATTENTION_PACKED_NAME)
+    with open(f"{packed_path}.tmp", 'wb') as packed_file:
+        for lon in range(shape[0]):
+            for lat_pl in range(shape[1]):
+                for head in range(shape[2]):
+                    with open(os.path.join(attention_dir, indices[(lon, lat_pl, head)]), 'rb') as chunk_file:
+                        packed_file.write(chunk_file.read())
+    os.replace(f"{packed_path}.tmp", packed_path)
+    save_attention_index(attention_dir, shape + (ATTENTION_WINDOW_SIZE, ATTENTION_WINDOW_SIZE), np.float32)
+
+    if not keep_files:
+        for name in indices.values():
+            os.remove(os.path.join(attention_dir, name))
+    if verbose:
+        print(f"Packed {len(indices)} files: {attention_dir}")
+    return True
+
+def main(args):
+    attention_dirs = find_attention_dirs(os.path.join(args.src_dir, 'bin'))
+    for attention_dir in tqdm(attention_dirs, desc="Packing attention layers"):
+        pack_attention_dir(attention_dir, keep_files=args.keep_files, verbose=args.verbose)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert per-window attention files into packed attention files.')
+    parser.add_argument('--src_dir', type=str, default='src', help='Directory of the web app containing the bin directory.')
+    parser.add_argument('--keep_files', action='store_true', help='Keep the per-window files after packing.')
+    parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
+
+    args = parser.parse_args()
+    main(args)
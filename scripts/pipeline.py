@@ -0,0 +1,111 @@
+import queue
+import threading
+from time import perf_counter
+
+STAGES = ['load', 'infer', 'write']
+POLL_INTERVAL = 0.1
+
+class StageError(RuntimeError):
+    """Raised in the calling thread when a background stage fails."""
+
+def _put(stage_queue, item, stop):
+    """Put an item on a bounded queue, giving up if another stage has failed."""
+    while not stop.is_set():
+        try:
+            stage_queue.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(stage_queue, stop):
+    """Take an item from a queue, giving up if another stage has failed."""
+    while not stop.is_set():
+        try:
+            return True, stage_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            continue
+    return False, None
+
+def run_overlapped(timesteps, load_fn, infer_fn, write_fn, queue_depth=1):
+    """Run load, infer and write for every timestep as three overlapping stages.
+
+    The next timestep is loaded on a background thread while the current one is inferred, and finished
+    timesteps are written on another background thread. Each queue holds at most queue_depth items, and one more
+    can wait on each side of it in the stage that is producing or consuming it, so at most queue_depth + 2 inputs
+    and queue_depth + 2 outputs are held in memory at once. Returns the wall time and the busy time of each stage.
+    """
+    load_queue = queue.Queue(maxsize=queue_depth)
+    write_queue = queue.Queue(maxsize=queue_depth)
+    busy = {stage: 0.0 for stage in STAGES}
+    errors = []
+    stop = threading.Event()
+
+    def loader():
+        try:
+            for timestep in timesteps:
+                start = perf_counter()
+                inputs = load_fn(*timestep)
+                busy['load'] += perf_counter() - start
+                if not _put(load_queue, (timestep, inputs), stop):
+                    return
+            _put(load_queue, None, stop)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def writer():
+        try:
+            while True:
+                ok, item = _get(write_queue, stop)
+                if not ok or item is None:
+                    return
+                timestep, outputs = item
+                start = perf_counter()
+                write_fn(*timestep, outputs)
+                busy['write'] += perf_counter() - start
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=loader, daemon=True), threading.Thread(target=writer, daemon=True)]
+    wall_start = perf_counter()
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            ok, item = _get(load_queue, stop)
+            if not ok or item is None:
+                break
+            timestep, inputs = item
+            start = perf_counter()
+            outputs = infer_fn(*inputs)
+            busy['infer'] += perf_counter() - start
+            del inputs, item
+            if not _put(write_queue, (timestep, outputs), stop):
+                break
+            del outputs
+        _put(write_queue, None, stop)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise StageError(f"Pipeline stage failed: {errors[0]!r}") from errors[0]
+
+    return {'wall': perf_counter() - wall_start, 'busy': busy, 'timesteps': len(timesteps)}
+
+def format_stage_report(stats):
+    """Summarise the utilisation of each stage, marking the bottleneck."""
+    wall = stats['wall']
+    bottleneck = max(STAGES, key=lambda stage: stats['busy'][stage])
+    lines = [f"Overlapped pipeline: {stats['timesteps']} timesteps in {wall:.2f}s"]
+    for stage in STAGES:
+        busy = stats['busy'][stage]
+        marker = " (bottleneck)" if stage == bottleneck else ""
+        lines.append(f"  {stage:<6} busy {busy:8.2f}s - utilisation {100 * busy / wall:5.1f}%{marker}")
+    return "\n".join(lines)
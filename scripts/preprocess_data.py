@@ -1,7 +1,16 @@
 import argparse
 import subprocess
 from datetime import datetime, timedelta
+from time import perf_counter
 from tqdm import tqdm
+from input_store import input_sources, INPUT_NAMES
+from save_activations import prepare_session, create_runner, process_timestep, load_data, run_model, save_output, save_formatted
+from pipeline import run_overlapped, format_stage_report
+from scheduler import run_scheduled
+from format_data import format_timestep, ATTENTION_DTYPES
+from attention_variants import ATTENTION_VARIANTS
+
+DATA_TIMES = ["00:00", "12:00"]
 
 def increment_date(current_date, increment):
     """Increment a date by a given number of days."""
@@ -18,6 +27,10 @@ def get_dates_in_range(start_date, end_date):
         current_date = increment_date(current_date, 1)
     return dates
 
+def get_timesteps(dates):
+    """Pair every date with each of the data times."""
+    return [(date, time) for date in dates for time in DATA_TIMES]
+
 def run_command(command):
     """Run a shell command."""
     result = subprocess.run(command, shell=True)
@@ -30,34 +43,134 @@ def download_data(start_date, end_date):
     command = f"python scripts/download_data.py --start_date {start_date} --end_date {end_date}"
     run_command(command)
 
-def save_activations(dates, model_num, intermediate_layers, num_threads):
+def get_format_options(args):
+    """Collect the attention storage options passed on to the formatting."""
+    return {'attention_dtype': args.attention_dtype, 'attention_top_k': args.attention_top_k, 'attention_mass': args.attention_mass,
+            'force': args.force, 'attention_variant': args.attention_variant, 'model_num': args.model_num}
+
+def format_flags(format_options):
+    """Command line flags for the formatting options that are set."""
+    flags = ""
+    for name, value in (format_options or {}).items():
+        if value is True:
+            flags += f" --{name}"
+        elif value is not None and value is not False:
+            flags += f" --{name} {value}"
+    return flags
+
+def save_activations(dates, model_num, intermediate_layers, num_threads, cache_size, activations_only, direct_format=False, keep_raw=False,
+                     format_options=None):
     """Phase 2: Save activations."""
     print(f"Phase 2: Saving activations for range {dates[0]} to {dates[-1]}...")
     for date in tqdm(dates, desc="Phase 2 Progress"):
-        for time in ["00:00", "12:00"]:
+        for time in DATA_TIMES:
             command = (
                 f"python scripts/save_activations.py "
                 f"--model_num {model_num} "
                 f"--data_date {date} "
                 f"--data_time {time} "
                 f"--intermediate_layers {intermediate_layers} "
-                f"--num_threads {num_threads}"
+                f"--num_threads {num_threads} "
+                f"--cache_size {cache_size} "
+                f"--attention_variant {(format_options or {}).get('attention_variant', 'post_bias')}"
             )
+            if activations_only:
+                command += " --activations_only"
+            if direct_format:
+                # The model and variant are already set for the export.
+                command += " --direct_format" + format_flags({name: value for name, value in (format_options or {}).items()
+                                                              if name not in ('model_num', 'attention_variant')})
+            if keep_raw:
+                command += " --keep_raw"
             run_command(command)
 
-def format_data(dates, intermediate_layers):
+def format_data(dates, intermediate_layers, format_options=None):
     """Phase 3: Format data."""
     print(f"Phase 3: Formatting data for range {dates[0]} to {dates[-1]}...")
     for date in tqdm(dates, desc="Phase 3 Progress"):
-        for time in ["00:00", "12:00"]:
+        for time in DATA_TIMES:
             command = (
                 f"python scripts/format_data.py "
                 f"--data_date {date} "
                 f"--data_time {time} "
                 f"--intermediate_layers {intermediate_layers}"
             )
+            command += format_flags(format_options)
             run_command(command)
 
+def run_pipeline(dates, args):
+    """Phases 2 and 3 in-process: load the model once and stream every timestep through it."""
+    print(f"Phase 2+3: Saving and formatting activations for range {dates[0]} to {dates[-1]}...")
+    layers = [int(layer) for layer in args.intermediate_layers.split()]
+    src_dir = "src" if args.direct_format else None
+    format_options = get_format_options(args)
+
+    setup_start = perf_counter()
+    session, output_names = prepare_session("checkpoints", args.model_num, layers, args.num_threads,
+                                            activations_only=args.activations_only, cache_size=args.cache_size, tuned=args.tuned,
+                                            attention_variant=args.attention_variant)
+    # Outputs may still be queued or being written while the next timesteps run, so they need their own buffers.
+    runner = create_runner(session, output_names, io_binding=args.tuned, num_buffers=args.queue_depth + 2 if args.overlap else 1)
+    print(f"Model setup: {perf_counter() - setup_start:.2f}s")
+
+    timesteps = get_timesteps(dates)
+    if args.overlap:
+        def infer(input_upper, input_surface):
+            return input_upper, input_surface, run_model(session, input_upper, input_surface, output_names, runner=runner)
+
+        def write(date, time, result):
+            input_upper, input_surface, outputs = result
+            if args.direct_format:
+                save_formatted("src", date, time, input_upper, input_surface, outputs, output_names, format_options=format_options,
+                               sources=dict(zip(INPUT_NAMES, input_sources("input_data", date, time))))
+            if not args.direct_format or args.keep_raw:
+                save_output("output_data", date, time, outputs, output_names)
+            if not args.direct_format:
+                format_timestep("src", "input_data", "output_data", date, time, layers, **format_options)
+
+        stats = run_overlapped(timesteps, lambda date, time: load_data("input_data", date, time), infer, write,
+                               queue_depth=args.queue_depth)
+        print(format_stage_report(stats))
+        total_time = stats['wall']
+        print(
+            f"Pipeline: {len(timesteps)} timesteps in {total_time:.2f}s - "
+            f"{total_time / len(timesteps):.2f}s per timestep, {len(timesteps) / total_time:.3f} timesteps/s"
+        )
+        return
+
+    inference_time = 0.0
+    format_time = 0.0
+    for date, time in tqdm(timesteps, desc="Pipeline Progress"):
+        stage_start = perf_counter()
+        process_timestep(session, output_names, "input_data", "output_data", date, time, runner=runner,
+                         src_dir=src_dir, keep_raw=args.keep_raw, format_options=format_options)
+        inference_time += perf_counter() - stage_start
+
+        if not args.direct_format:
+            stage_start = perf_counter()
+            format_timestep("src", "input_data", "output_data", date, time, layers, **format_options)
+            format_time += perf_counter() - stage_start
+
+    total_time = inference_time + format_time
+    print(
+        f"Pipeline: {len(timesteps)} timesteps in {total_time:.2f}s - "
+        f"{total_time / len(timesteps):.2f}s per timestep "
+        f"(activations {inference_time / len(timesteps):.2f}s, formatting {format_time / len(timesteps):.2f}s), "
+        f"{len(timesteps) / total_time:.3f} timesteps/s"
+    )
+
+def run_pool(dates, args):
+    """Phases 2 and 3 on a pool of worker processes sized to the core and RAM budgets."""
+    print(f"Phase 2+3: Saving and formatting activations for range {dates[0]} to {dates[-1]} on a process pool...")
+    layers = [int(layer) for layer in args.intermediate_layers.split()]
+    failed = run_scheduled(get_timesteps(dates), "checkpoints", args.model_num, layers, args.core_budget, args.ram_budget_gb,
+                           session_ram_gb=args.session_ram_gb, activations_only=args.activations_only, cache_size=args.cache_size,
+                           max_retries=args.max_retries, tuned=args.tuned, src_dir="src",
+                           direct_format=args.direct_format, keep_raw=args.keep_raw,
+                           format_options=get_format_options(args))
+    if failed:
+        raise RuntimeError(f"Failed timesteps: {', '.join(f'{date} {time}' for date, time in failed)}")
+
 def main():
     parser = argparse.ArgumentParser(description="Process data with progress bars.")
     parser.add_argument("--start_date", help="Start date in YYYY-MM-DD format.")
@@ -65,14 +178,42 @@ def main():
     parser.add_argument("--model_num", type=int, default=24, help="Model number.")
     parser.add_argument("--intermediate_layers", default="0 1 2 3", help="Intermediate layers.")
     parser.add_argument("--num_threads", type=int, default=4, help="Number of threads.")
+    parser.add_argument("--cache_size", type=int, default=2, help="Number of modified models to keep cached.")
+    parser.add_argument("--activations_only", action="store_true", help="Only run the model up to the deepest requested layer.")
+    parser.add_argument("--direct_format", action="store_true", help="Write activations straight into the web app layout, skipping output_data.")
+    parser.add_argument("--keep_raw", action="store_true", help="With --direct_format, also save the raw activations to output_data.")
+    parser.add_argument("--attention_dtype", choices=ATTENTION_DTYPES, default="float32", help="Storage type of the packed attention data.")
+    sparse_group = parser.add_mutually_exclusive_group()
+    sparse_group.add_argument("--attention_top_k", type=int, help="Store only the top k softmax weights of each query.")
+    sparse_group.add_argument("--attention_mass", type=float, help="Store only the largest softmax weights of each query that add up to this mass.")
+    parser.add_argument("--attention_variant", choices=ATTENTION_VARIANTS, default="post_bias", help="Attention to show: the scores before or after the positional bias, or the softmax weights.")
+    parser.add_argument("--force", action="store_true", help="Format every output again, even those that are up to date.")
+    parser.add_argument("--tuned", action="store_true", help="Use the tuned session mode with IO binding in the in-process and pool modes.")
+    parser.add_argument("--in_process", action="store_true", help="Keep the model loaded and process every timestep in a single process.")
+    parser.add_argument("--overlap", action="store_true", help="With --in_process, overlap loading, inference and writing of consecutive timesteps.")
+    parser.add_argument("--queue_depth", type=int, default=1, help="Number of timesteps each overlapped stage may queue.")
+    parser.add_argument("--core_budget", type=int, help="Total cores to share between worker processes, enables the process pool.")
+    parser.add_argument("--ram_budget_gb", type=float, default=16, help="Total RAM in GiB the worker processes may use.")
+    parser.add_argument("--session_ram_gb", type=float, help="RAM in GiB needed by one session, estimated from the model size by default.")
+    parser.add_argument("--max_retries", type=int, default=2, help="Number of times a failed timestep is retried on the process pool.")
 
     args = parser.parse_args()
+    if args.overlap and (not args.in_process or args.core_budget):
+        parser.error("--overlap requires --in_process and cannot be combined with --core_budget.")
 
     dates = get_dates_in_range(args.start_date, args.end_date)
 
     download_data(args.start_date, args.end_date)
-    save_activations(dates, args.model_num, args.intermediate_layers, args.num_threads)
-    format_data(dates, args.intermediate_layers)
+    if args.core_budget:
+        run_pool(dates, args)
+    elif args.in_process:
+        run_pipeline(dates, args)
+    else:
+        save_activations(dates, args.model_num, args.intermediate_layers, args.num_threads, args.cache_size, args.activations_only,
+                         direct_format=args.direct_format, keep_raw=args.keep_raw,
+                         format_options=get_format_options(args))
+        if not args.direct_format:
+            format_data(dates, args.intermediate_layers, format_options=get_format_options(args))
 
     print(f"Data setup completed for range {args.start_date} to {args.end_date}.")
 
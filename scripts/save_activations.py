@@ -1,9 +1,22 @@
 import os
+import itertools
+import multiprocessing
+import resource
 import numpy as np
 import onnx
 import onnxruntime as ort
-from time import time
+from time import time, perf_counter
 import argparse
+import model_cache
+from input_store import load_inputs, input_sources, INPUT_NAMES
+from format_data import format_arrays, ATTENTION_DTYPES
+from attention_variants import ATTENTION_VARIANTS, EXPORTED_VARIANTS, find_layer, variant_layer_name
+
+ORT_TYPES = {
+    'tensor(float)': np.float32,
+    'tensor(float16)': np.float16,
+    'tensor(double)': np.float64,
+}
 
 def log_time(func):
     """Decorator to log the time taken by a function."""
@@ -38,30 +51,103 @@ def create_inter_output(model, layer_name_list, verbose=False):
     return model
 
 @log_time
-def create_session(model_path, output_names, num_threads, verbose=False):
-    """Create an ONNX Runtime session."""
+def create_truncated_model(model, layer_name_list, verbose=False):
+    """Extract the subgraph from the model inputs up to the intermediate layers, dropping the forecast."""
+    input_names = [graph_input.name for graph_input in model.graph.input]
+    extractor = onnx.utils.Extractor(onnx.shape_inference.infer_shapes(model))
+    return extractor.extract_model(input_names, layer_name_list)
+
+@log_time
+def create_session(model_path, output_names, num_threads, tuned=False, profile_prefix=None, verbose=False):
+    """Create an ONNX Runtime session.
+
+    By default the memory arena, memory patterns and memory reuse are disabled to keep the footprint low.
+    With tuned they are enabled, the graph is fully optimised and the optimised graph is cached next to the
+    model so later sessions skip the optimisation. With profile_prefix the session records an ORT profile,
+    written to a file starting with the prefix when session.end_profiling() is called.
+    """
     options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = False
-    options.enable_mem_pattern = False
-    options.enable_mem_reuse = False
     options.intra_op_num_threads = num_threads
+    if profile_prefix is not None:
+        options.enable_profiling = True
+        options.profile_file_prefix = profile_prefix
+    optimized_path = None
+    if tuned:
+        options.enable_cpu_mem_arena = True
+        options.enable_mem_pattern = True
+        options.enable_mem_reuse = True
+        cached_path = model_cache.optimized_model_path(model_path)
+        if os.path.exists(cached_path):
+            model_path = cached_path
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            optimized_path = cached_path
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.optimized_model_filepath = f"{cached_path}.{os.getpid()}.tmp"
+    else:
+        options.enable_cpu_mem_arena = False
+        options.enable_mem_pattern = False
+        options.enable_mem_reuse = False
     session = ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+    if optimized_path is not None:
+        os.replace(options.optimized_model_filepath, optimized_path)
     
     session_outputs = session.get_outputs()
     output_names.extend([output.name for output in session_outputs])
     
     return session
 
+def allocate_outputs(session, output_names):
+    """Allocate an array for each session output, or None where the output shape is not static."""
+    session_outputs = {output.name: output for output in session.get_outputs()}
+    buffers = []
+    for name in output_names:
+        output = session_outputs[name]
+        static = all(isinstance(dim, int) for dim in output.shape)
+        buffers.append(np.empty(output.shape, dtype=ORT_TYPES[output.type]) if static else None)
+    return buffers
+
+def create_runner(session, output_names, io_binding=False, num_buffers=1):
+    """Return a function that runs the model on one timestep and returns its outputs.
+
+    With io_binding the outputs are written into num_buffers preallocated sets of arrays that are used in
+    turn, so the arrays returned by a call are overwritten num_buffers calls later.
+    """
+    if not io_binding:
+        return lambda input_data, input_surface_data: session.run(output_names, {'input': input_data, 'input_surface': input_surface_data})
+
+    binding = session.io_binding()
+    buffer_sets = [allocate_outputs(session, output_names) for _ in range(num_buffers)]
+    calls = itertools.count()
+
+    def run(input_data, input_surface_data):
+        buffers = buffer_sets[next(calls) % num_buffers]
+        binding.bind_cpu_input('input', input_data)
+        binding.bind_cpu_input('input_surface', input_surface_data)
+        for name, buffer in zip(output_names, buffers):
+            if buffer is None:
+                binding.bind_output(name, 'cpu')
+            else:
+                binding.bind_output(name, 'cpu', 0, buffer.dtype, buffer.shape, buffer.ctypes.data)
+        session.run_with_iobinding(binding)
+        if any(buffer is None for buffer in buffers):
+            allocated = binding.copy_outputs_to_cpu()
+            return [allocated[i] if buffer is None else buffer for i, buffer in enumerate(buffers)]
+        return buffers
+
+    return run
+
 @log_time
 def load_data(input_dir, data_date, data_time, verbose=False):
-    """Load input data."""
-    input_upper = np.load(os.path.join(input_dir, data_date, data_time, 'input_upper.npy')).astype(np.float32)
-    input_surface = np.load(os.path.join(input_dir, data_date, data_time, 'input_surface.npy')).astype(np.float32)
-    return input_upper, input_surface
+    """Load input data, as memory-mapped views without a copy if the timestep is in the input store."""
+    input_upper, input_surface = load_inputs(input_dir, data_date, data_time)
+    return input_upper.astype(np.float32, copy=False), input_surface.astype(np.float32, copy=False)
 
 @log_time
-def run_model(session, input_data, input_surface_data, output_names, verbose=False):
-    """Run the model inference."""
+def run_model(session, input_data, input_surface_data, output_names, runner=None, verbose=False):
+    """Run the model inference, through the runner from create_runner if given."""
+    if runner is not None:
+        return runner(input_data, input_surface_data)
     return session.run(output_names, {'input': input_data, 'input_surface': input_surface_data})
 
 @log_time
@@ -89,51 +175,149 @@ def print_layer_outputs(model, verbose=False):
         for node in model.graph.node:
             print(node.output)
 
-def main(args):
-    model_path = os.path.join(args.models_dir, f'pangu_weather_{args.model_num}.onnx')
-    model = load_model(model_path, verbose=args.verbose)
-    
-    intermediate_layer_name = [
-        '/b1/Add_output_0', 
-        '/b1/Add_3_output_0',
-        '/b1/Add_7_output_0', 
-        '/b1/Add_10_output_0',
-        '/b1/Add_14_output_0', 
-        '/b1/Add_17_output_0',
-        '/b1/Add_21_output_0', 
-        '/b1/Add_24_output_0',
-        '/b1/Add_28_output_0', 
-        '/b1/Add_31_output_0',
-        '/b1/Add_35_output_0', 
-        '/b1/Add_38_output_0',
-        '/b1/Add_42_output_0', 
-        '/b1/Add_45_output_0',
-        '/b1/Add_49_output_0',
-        '/b1/Add_52_output_0',
-    ]
-
-    selected_layers = [intermediate_layer_name[i] for i in args.intermediate_layers]
-    model = create_inter_output(model, selected_layers, verbose=args.verbose)
+def prepare_model(models_dir, model_num, selected_layers, activations_only=False, cache_size=2, verbose=False):
+    """Return the path of the model with the selected layers exposed, building it only on a cache miss.
+
+    With activations_only the model is truncated after the deepest selected layer and only outputs the activations.
+    """
+    model_path = os.path.join(models_dir, f'pangu_weather_{model_num}.onnx')
+    key = model_cache.cache_key(model_cache.hash_model(model_path), model_num, selected_layers, activations_only=activations_only)
+    modified_model_path = model_cache.cached_model_path(models_dir, model_num, key)
+
+    if model_cache.lookup(modified_model_path):
+        if verbose:
+            print(f"Model Cache: Hit - {os.path.basename(modified_model_path)}")
+    else:
+        if verbose:
+            print(f"Model Cache: Miss - {os.path.basename(modified_model_path)}")
+        model = load_model(model_path, verbose=verbose)
+        if activations_only:
+            model = create_truncated_model(model, selected_layers, verbose=verbose)
+        else:
+            model = create_inter_output(model, selected_layers, verbose=verbose)
 
-    try:
         onnx.checker.check_model(model)
-        if args.verbose:
+        if verbose:
             print("Model Modifications: Valid")
-    except onnx.checker.ValidationError as e:
-        if args.verbose:
-            print(f"Model Modifications: Invalid - {e}")
-        return
 
-    modified_model_path = os.path.join(args.models_dir, f'pangu_weather_modified.onnx')
-    save_model(model, modified_model_path, verbose=args.verbose)
+        model_cache.store(modified_model_path, lambda path: save_model(model, path, verbose=verbose))
+
+    model_cache.evict(models_dir, cache_size, keep=[modified_model_path], verbose=verbose)
+    return modified_model_path
+
+def prepare_session(models_dir, model_num, intermediate_layers, num_threads, activations_only=False, cache_size=2, tuned=False,
+                    attention_variant='post_bias', profile_prefix=None, verbose=False):
+    """Prepare the model with the intermediate layers exposed and create a session for it.
+
+    Only the tensor exported for attention_variant is exposed for each layer, the formatter derives the variant from it.
+    """
+    selected_layers = [variant_layer_name(EXPORTED_VARIANTS[attention_variant], i, models_dir, model_num) for i in intermediate_layers]
+    modified_model_path = prepare_model(models_dir, model_num, selected_layers, activations_only=activations_only,
+                                        cache_size=cache_size, verbose=verbose)
     
     output_names = []
-    ort_session = create_session(modified_model_path, output_names, args.num_threads, verbose=args.verbose)
-    input_data, input_surface_data = load_data(args.input_data_dir, args.data_date, args.data_time, verbose=args.verbose)
+    session = create_session(modified_model_path, output_names, num_threads, tuned=tuned, profile_prefix=profile_prefix, verbose=verbose)
+    return session, output_names
+
+@log_time
+def save_formatted(src_dir, data_date, data_time, input_data, input_surface_data, outputs, output_names, format_options=None,
+                   sources=None, verbose=False):
+    """Write the inputs and the intermediate layer outputs straight into the web app layout.
+
+    format_options are passed on to format_data.format_arrays. sources fingerprints the inputs, so their map
+    tiles are only rewritten when they changed.
+    """
+    format_options = format_options or {}
+    attention_outputs, source_variants = {}, {}
+    for name, output in zip(output_names, outputs):
+        layer = find_layer(name, format_options.get('models_dir', 'checkpoints'), format_options.get('model_num'))
+        if layer is not None:
+            source_variants[layer[1]], attention_outputs[layer[1]] = layer[0], output
+    format_arrays(src_dir, data_date, data_time, input_data, input_surface_data, attention_outputs, source_variants=source_variants,
+                  sources=sources, **format_options)
+
+def process_timestep(session, output_names, input_data_dir, output_data_dir, data_date, data_time, runner=None,
+                     src_dir=None, keep_raw=True, format_options=None, verbose=False):
+    """Run the model on a single timestep and save its outputs.
+
+    With src_dir the outputs are formatted straight into the web app layout, and only saved as raw arrays
+    as well if keep_raw is set.
+    """
+    input_data, input_surface_data = load_data(input_data_dir, data_date, data_time, verbose=verbose)
     
-    outputs = run_model(ort_session, input_data, input_surface_data, output_names, verbose=args.verbose)
+    outputs = run_model(session, input_data, input_surface_data, output_names, runner=runner, verbose=verbose)
+
+    if src_dir is not None:
+        save_formatted(src_dir, data_date, data_time, input_data, input_surface_data, outputs, output_names,
+                       format_options=format_options, sources=dict(zip(INPUT_NAMES, input_sources(input_data_dir, data_date, data_time))),
+                       verbose=verbose)
+    if src_dir is None or keep_raw:
+        save_output(output_data_dir, data_date, data_time, outputs, output_names, verbose=verbose)
+
+def measure_session_mode(tuned, models_dir, model_num, intermediate_layers, num_threads, activations_only,
+                         input_data_dir, data_date, data_time, runs, attention_variant='post_bias'):
+    """Time the session setup and repeated inference of one session mode, with the peak RSS of the process.
+
+    The modified model is expected to be cached already, so the setup time is that of the session alone.
+    """
+    setup_start = perf_counter()
+    session, output_names = prepare_session(models_dir, model_num, intermediate_layers, num_threads,
+                                            activations_only=activations_only, tuned=tuned, attention_variant=attention_variant)
+    runner = create_runner(session, output_names, io_binding=tuned)
+    setup_time = perf_counter() - setup_start
+    input_data, input_surface_data = load_data(input_data_dir, data_date, data_time)
+
+    latencies = []
+    for _ in range(runs):
+        start = perf_counter()
+        runner(input_data, input_surface_data)
+        latencies.append(perf_counter() - start)
+    return setup_time, latencies, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def compare_session_modes(args):
+    """Compare the conservative and tuned session modes, each in a fresh process so peak RSS is not shared."""
+    # Build the modified model once so neither mode pays for loading and saving the full model.
+    prepare_model(args.models_dir, args.model_num,
+                  [variant_layer_name(EXPORTED_VARIANTS[args.attention_variant], i, args.models_dir, args.model_num)
+                   for i in args.intermediate_layers],
+                  activations_only=args.activations_only, cache_size=args.cache_size)
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for tuned in (False, True):
+        with context.Pool(1) as pool:
+            results['tuned' if tuned else 'conservative'] = pool.apply(measure_session_mode, (
+                tuned, args.models_dir, args.model_num, args.intermediate_layers, args.num_threads, args.activations_only,
+                args.input_data_dir, args.data_date, args.data_time, args.compare_runs, args.attention_variant))
+
+    print(f"{'Mode':<14}{'Setup (s)':>12}{'First run (s)':>15}{'Mean run (s)':>14}{'Peak RSS (MiB)':>16}")
+    for mode, (setup_time, latencies, peak_rss) in results.items():
+        steady = latencies[1:] or latencies
+        print(f"{mode:<14}{setup_time:>12.2f}{latencies[0]:>15.2f}{sum(steady) / len(steady):>14.2f}{peak_rss:>16.0f}")
+
+def format_options(args):
+    """Collect the formatting arguments used by --direct_format."""
+    return {'attention_format': args.attention_format, 'attention_dtype': args.attention_dtype,
+            'attention_top_k': args.attention_top_k, 'attention_mass': args.attention_mass, 'force': args.force,
+            'attention_variant': args.attention_variant, 'models_dir': args.models_dir, 'model_num': args.model_num}
+
+def main(args):
+    if args.compare_session_modes:
+        compare_session_modes(args)
+        return
+
+    try:
+        ort_session, output_names = prepare_session(args.models_dir, args.model_num, args.intermediate_layers, args.num_threads,
+                                                   activations_only=args.activations_only, cache_size=args.cache_size,
+                                                   tuned=args.tuned, attention_variant=args.attention_variant, verbose=args.verbose)
+    except onnx.checker.ValidationError as e:
+        if args.verbose:
+            print(f"Model Modifications: Invalid - {e}")
+        return
 
-    save_output(args.output_data_dir, args.data_date, args.data_time, outputs, output_names, verbose=args.verbose)
+    runner = create_runner(ort_session, output_names, io_binding=args.tuned)
+    src_dir = args.src_dir if args.direct_format else None
+    process_timestep(ort_session, output_names, args.input_data_dir, args.output_data_dir, args.data_date, args.data_time,
+                     runner=runner, src_dir=src_dir, keep_raw=args.keep_raw, format_options=format_options(args), verbose=args.verbose)
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run ONNX model with specified parameters.')
@@ -145,6 +329,21 @@ if __name__ == "__main__":
     parser.add_argument('--output_data_dir', type=str, default='output_data', help='Directory for output data.')
     parser.add_argument('--models_dir', type=str, default='checkpoints', help='Directory for model checkpoints.')
     parser.add_argument('--num_threads', type=int, default=4, help='Number of threads to use for ONNX Runtime session.')
+    parser.add_argument('--activations_only', action='store_true', help='Only run the model up to the deepest intermediate layer and skip the forecast outputs.')
+    parser.add_argument('--cache_size', type=int, default=2, help='Number of modified models to keep cached in the models directory.')
+    parser.add_argument('--tuned', action='store_true', help='Enable the ORT memory arena and graph optimisations, and bind outputs to preallocated buffers.')
+    parser.add_argument('--compare_session_modes', action='store_true', help='Compare latency and peak RSS of the conservative and tuned session modes.')
+    parser.add_argument('--compare_runs', type=int, default=3, help='Number of inference runs per mode when comparing session modes.')
+    parser.add_argument('--attention_variant', choices=ATTENTION_VARIANTS, default='post_bias', help='Attention to export: the scores before or after the positional bias, or the softmax weights derived from the latter.')
+    parser.add_argument('--direct_format', action='store_true', help='Write the inputs and activations straight into the web app layout.')
+    parser.add_argument('--keep_raw', action='store_true', help='With --direct_format, also save the raw outputs to the output data directory.')
+    parser.add_argument('--src_dir', type=str, default='src', help='Directory of the web app for --direct_format.')
+    parser.add_argument('--attention_format', choices=['packed', 'files'], default='packed', help='Layout of the attention data for --direct_format.')
+    parser.add_argument('--attention_dtype', choices=ATTENTION_DTYPES, default='float32', help='Storage type of the packed attention for --direct_format.')
+    parser.add_argument('--force', action='store_true', help='With --direct_format, rewrite the map tiles even if they are up to date.')
+    sparse_group = parser.add_mutually_exclusive_group()
+    sparse_group.add_argument('--attention_top_k', type=int, help='With --direct_format, store only the top k softmax weights of each query.')
+    sparse_group.add_argument('--attention_mass', type=float, help='With --direct_format, store only the largest softmax weights of each query that add up to this mass.')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output.')
 
     args = parser.parse_args()
@@ -0,0 +1,137 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from tqdm import tqdm
+from save_activations import prepare_model, prepare_session, create_runner, process_timestep
+from format_data import format_timestep
+from attention_variants import EXPORTED_VARIANTS, variant_layer_name
+
+GIB = 1024 ** 3
+# A CPU session holds the weights, the optimised graph and the activations of a full forecast.
+SESSION_RAM_PER_MODEL_BYTE = 4
+SESSION_RAM_OVERHEAD = 2 * GIB
+
+_worker = {}
+
+def estimate_session_ram(model_path):
+    """Rough peak RAM of one inference session, in GiB, from the size of the model file."""
+    return (os.path.getsize(model_path) * SESSION_RAM_PER_MODEL_BYTE + SESSION_RAM_OVERHEAD) / GIB
+
+def plan_workers(core_budget, ram_budget_gb, session_ram_gb, num_timesteps):
+    """Split the core budget between as many sessions as the RAM budget allows.
+
+    Returns the number of worker processes and the intra-op threads each of them may use.
+    """
+    max_by_ram = int(ram_budget_gb // session_ram_gb)
+    if max_by_ram < 1:
+        print(f"Scheduler: RAM budget of {ram_budget_gb:.1f} GiB is below the {session_ram_gb:.1f} GiB estimate for one session, using a single worker.")
+        max_by_ram = 1
+    num_workers = max(1, min(core_budget, max_by_ram, num_timesteps))
+    return num_workers, max(1, core_budget // num_workers)
+
+def _init_worker(models_dir, model_num, intermediate_layers, num_threads, activations_only, cache_size, tuned, data_dirs, direct_format, keep_raw,
+                 format_options, started):
+    """Create the session once per worker process. Timesteps are put on started as the worker begins them."""
+    attention_variant = (format_options or {}).get('attention_variant', 'post_bias')
+    _worker['session'], _worker['output_names'] = prepare_session(
+        models_dir, model_num, intermediate_layers, num_threads, activations_only=activations_only, cache_size=cache_size, tuned=tuned,
+        attention_variant=attention_variant)
+    _worker['runner'] = create_runner(_worker['session'], _worker['output_names'], io_binding=tuned)
+    _worker['intermediate_layers'] = intermediate_layers
+    _worker['data_dirs'] = data_dirs
+    _worker['direct_format'] = direct_format
+    _worker['keep_raw'] = keep_raw
+    _worker['format_options'] = format_options or {}
+    _worker['started'] = started
+
+def _run_timestep(data_date, data_time):
+    """Extract the activations of one timestep in a worker, formatting them if a source directory is set."""
+    _worker['started'].put((data_date, data_time))
+    input_data_dir, output_data_dir, src_dir = _worker['data_dirs']
+    direct_format = src_dir is not None and _worker['direct_format']
+    process_timestep(_worker['session'], _worker['output_names'], input_data_dir, output_data_dir, data_date, data_time,
+                     runner=_worker['runner'], src_dir=src_dir if direct_format else None, keep_raw=_worker['keep_raw'],
+                     format_options=_worker['format_options'])
+    if src_dir is not None and not direct_format:
+        format_timestep(src_dir, input_data_dir, output_data_dir, data_date, data_time, _worker['intermediate_layers'],
+                        **_worker['format_options'])
+
+def run_scheduled(timesteps, models_dir, model_num, intermediate_layers, core_budget, ram_budget_gb, session_ram_gb=None,
+                  activations_only=False, cache_size=2, max_retries=2, tuned=False, input_data_dir='input_data',
+                  output_data_dir='output_data', src_dir=None, direct_format=False, keep_raw=False, format_options=None):
+    """Process timesteps on a pool of worker processes sized to the core and RAM budgets.
+
+    Failed timesteps are retried up to max_retries times. A worker killed by the OS breaks the pool: the timesteps
+    that had not started are resubmitted to a fresh pool without charging an attempt, and the ones that were running
+    are rerun alone so only the timestep that killed its worker is charged. A pool that breaks before running any
+    timestep failed to initialise its workers, which is raised. With direct_format the activations are formatted straight
+    into src_dir, skipping output_data unless keep_raw is set. format_options are passed on to the formatting. Returns the timesteps that still failed.
+    """
+    # Build the modified model once so the workers only read it from the cache.
+    exported_variant = EXPORTED_VARIANTS[(format_options or {}).get('attention_variant', 'post_bias')]
+    prepare_model(models_dir, model_num, [variant_layer_name(exported_variant, i, models_dir, model_num) for i in intermediate_layers],
+                  activations_only=activations_only, cache_size=cache_size)
+
+    if session_ram_gb is None:
+        session_ram_gb = estimate_session_ram(os.path.join(models_dir, f'pangu_weather_{model_num}.onnx'))
+    num_workers, num_threads = plan_workers(core_budget, ram_budget_gb, session_ram_gb, len(timesteps))
+    print(f"Scheduler: {num_workers} workers x {num_threads} threads "
+          f"({session_ram_gb:.1f} GiB per session, budget {core_budget} cores / {ram_budget_gb:.1f} GiB)")
+
+    init_args = (models_dir, model_num, intermediate_layers, num_threads, activations_only, cache_size, tuned,
+                 (input_data_dir, output_data_dir, src_dir), direct_format, keep_raw, format_options)
+    attempts = {timestep: 0 for timestep in timesteps}
+    pending = list(timesteps)
+    # Timesteps that were running when a worker died, each rerun in a pool of its own.
+    suspects = []
+    failed = []
+    progress_bar = tqdm(total=len(timesteps), desc="Scheduled Progress")
+
+    def charge(timestep, error):
+        attempts[timestep] += 1
+        if attempts[timestep] > max_retries:
+            print(f"Scheduler: {timestep[0]} {timestep[1]} failed after {attempts[timestep]} attempts - {error!r}")
+            failed.append(timestep)
+            progress_bar.update(1)
+        else:
+            pending.append(timestep)
+
+    context = multiprocessing.get_context('spawn')
+    while pending or suspects:
+        if suspects:
+            batch = [suspects.pop()]
+        else:
+            batch, pending = pending, []
+        started = context.SimpleQueue()
+        broken, broken_error = [], None
+        with ProcessPoolExecutor(min(num_workers, len(batch)), mp_context=context,
+                                 initializer=_init_worker, initargs=init_args + (started,)) as pool:
+            futures = {pool.submit(_run_timestep, *timestep): timestep for timestep in batch}
+            for future in as_completed(futures):
+                timestep = futures[future]
+                try:
+                    future.result()
+                    progress_bar.update(1)
+                except BrokenProcessPool as e:
+                    broken.append(timestep)
+                    broken_error = e
+                except Exception as e:
+                    charge(timestep, e)
+        if not broken:
+            continue
+        running = set()
+        while not started.empty():
+            running.add(started.get())
+        running = [timestep for timestep in broken if timestep in running]
+        if not running:
+            progress_bar.close()
+            raise BrokenProcessPool("Scheduler: a worker died before running any timestep, check that the session "
+                                    "can be created.") from broken_error
+        pending.extend(timestep for timestep in broken if timestep not in running)
+        if len(running) == 1:
+            charge(running[0], broken_error)
+        else:
+            suspects.extend(running)
+    progress_bar.close()
+    return failed
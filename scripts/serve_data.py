@@ -0,0 +1,259 @@
+import io
+import os
+import re
+import gzip
+import json
+import hashlib
+import argparse
+import numpy as np
+from functools import partial, lru_cache
+from urllib.parse import unquote, urlsplit
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from format_data import AVAILABLE_DATA_NAME, map_tile, num_attention_heads
+from attention_variants import find_layer
+from input_store import load_inputs, input_sources, file_fingerprint, INPUT_NAMES
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+MAP_TILE_PATTERN = re.compile(
+    r'/bin/(?P<date>[^/]+)/(?P<time>[^/]+)/config_(?P<chunk_lat>\d+)x(?P<chunk_lon>\d+)(?:_upper_(?P<level>\d+))?(?P<shifted>_shifted)?'
+    r'/map/(?P<data_type>input_surface|input_upper)_(?P<lat>\d+)_(?P<lon>\d+)\.bin$')
+ATTENTION_PATTERN = re.compile(
+    r'/bin/(?P<date>[^/]+)/(?P<time>[^/]+)/(?P<layer>[^/]+)/attention/attention_(?P<lon>\d+)_(?P<lat_pl>\d+)_(?P<head>\d+)\.bin$')
+GZIP_LEVEL = 6
+
+def safe_components(*components):
+    """Return True if none of the path components taken from a URL is '.' or '..', which would leave the data directories."""
+    return not any(component in ('.', '..') for component in components)
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Static file handler that also answers single byte range requests, as used for packed attention files."""
+
+    range_length = None
+
+    def send_head(self):
+        self.range_length = None
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if range_header is None or not os.path.isfile(path):
+            return super().send_head()
+
+        match = RANGE_PATTERN.match(range_header.strip())
+        size = os.path.getsize(path)
+        if not match or not any(match.groups()):
+            return super().send_head()
+        if match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        else:
+            start = max(size - int(match.group(2)), 0)
+            end = size - 1
+        if start >= size or start > end:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.end_headers()
+            return None
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self.range_length = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        length = self.range_length
+        if length is None:
+            return super().copyfile(source, outputfile)
+        while length > 0:
+            chunk = source.read(min(length, 64 * 1024))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            length -= len(chunk)
+
+    def end_headers(self):
+        if self.headers.get('Range') is None:
+            self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+class SliceSource:
+    """Render map tiles and attention heads on request from the raw input and output arrays.
+
+    The arrays are memory-mapped, so only the requested slice is read, and the most recently rendered slices
+    are kept in an LRU cache keyed by the fingerprint of their source file.
+    """
+
+    def __init__(self, input_data_dir='input_data', output_data_dir='output_data', cache_size=512, models_dir='checkpoints', model_num=None):
+        self.input_data_dir = input_data_dir
+        self.output_data_dir = output_data_dir
+        self.models_dir = models_dir
+        self.model_num = model_num
+        self._cached_render = lru_cache(maxsize=cache_size)(self._render)
+
+    def resolve(self, path):
+        """Return the slice of a URL path and the fingerprint of its source, or None if the path is not a slice with data."""
+        match = MAP_TILE_PATTERN.match(path)
+        if match:
+            if not safe_components(match['date'], match['time']):
+                return None
+            data_type = match['data_type']
+            if (data_type == 'input_upper') != (match['level'] is not None):
+                return None
+            try:
+                fingerprint = input_sources(self.input_data_dir, match['date'], match['time'])[INPUT_NAMES.index(data_type)]
+            except FileNotFoundError:
+                return None
+            key = ('map', match['date'], match['time'], data_type, int(match['level'] or 0), int(match['lat']), int(match['lon']),
+                   int(match['chunk_lat']), int(match['chunk_lon']), match['shifted'] is not None)
+            return key, None if fingerprint is None else tuple(fingerprint)
+
+        match = ATTENTION_PATTERN.match(path)
+        if match:
+            if not safe_components(match['date'], match['time'], match['layer']):
+                return None
+            attention_path = os.path.join(self.output_data_dir, match['date'], match['time'], f"{match['layer']}.npy")
+            if not os.path.exists(attention_path):
+                return None
+            key = ('attention', match['date'], match['time'], match['layer'], int(match['lon']), int(match['lat_pl']), int(match['head']))
+            return key, tuple(file_fingerprint(attention_path))
+        return None
+
+    def _render(self, key, fingerprint, compress=False):
+        """Render a slice as float32 bytes, gzipped if compress is set. Raises IndexError if it is out of range.
+
+        The fingerprint is only part of the cache key, so a slice is rendered again once its source changes.
+        """
+        if key[0] == 'map':
+            _, data_date, data_time, data_type, level, lat_index, lon_index, chunk_size_lat, chunk_size_lon, roll_data = key
+            input_upper, input_surface = load_inputs(self.input_data_dir, data_date, data_time, mmap_mode='r')
+            input_data = input_upper if data_type == 'input_upper' else input_surface[:, np.newaxis]
+            data = map_tile(input_data, level, lat_index, lon_index, chunk_size_lat, chunk_size_lon, roll_data=roll_data)
+        else:
+            _, data_date, data_time, layer, lon, lat_pl, head = key
+            attention_output = np.load(os.path.join(self.output_data_dir, data_date, data_time, f"{layer}.npy"), mmap_mode='r')
+            found = find_layer(layer, self.models_dir, self.model_num)
+            num_heads = num_attention_heads(found[1], self.models_dir, self.model_num) if found else attention_output.shape[2]
+            if not (lon < attention_output.shape[0] and lat_pl < attention_output.shape[1] and head < num_heads):
+                raise IndexError(f"No attention slice {lon}, {lat_pl}, {head} in {layer}")
+            data = attention_output[lon, lat_pl, head]
+        body = np.ascontiguousarray(data, dtype=np.float32).tobytes()
+        return gzip.compress(body, compresslevel=GZIP_LEVEL) if compress else body
+
+    def get(self, key, fingerprint, compress=False):
+        """Return the bytes of a slice, from the cache unless the fingerprint of its source is unknown."""
+        if fingerprint is None:
+            return self._render(key, fingerprint, compress)
+        return self._cached_render(key, fingerprint, compress)
+
+    def available_data(self, src_dir):
+        """The formatted timesteps of available_data.json, with every timestep in output_data that has inputs added."""
+        available_data = {}
+        json_path = os.path.join(src_dir, AVAILABLE_DATA_NAME)
+        if os.path.exists(json_path):
+            with open(json_path) as json_file:
+                available_data = json.load(json_file)
+        if not os.path.isdir(self.output_data_dir):
+            return available_data
+        for data_date in sorted(os.listdir(self.output_data_dir)):
+            date_path = os.path.join(self.output_data_dir, data_date)
+            if not os.path.isdir(date_path):
+                continue
+            for data_time in sorted(os.listdir(date_path)):
+                layers = [name[:-len('.npy')] for name in os.listdir(os.path.join(date_path, data_time))
+                          if name.endswith('.npy') and find_layer(name[:-len('.npy')], self.models_dir, self.model_num)]
+                try:
+                    input_sources(self.input_data_dir, data_date, data_time)
+                except FileNotFoundError:
+                    continue
+                if layers:
+                    times = available_data.setdefault(data_date, {})
+                    times[data_time] = sorted(set(times.get(data_time, [])) | set(layers))
+        return available_data
+
+class SliceRequestHandler(RangeRequestHandler):
+    """Web app handler that renders map tiles and attention heads which have not been formatted from the raw arrays.
+
+    Formatted files are served as they are. Rendered slices carry an ETag, answer conditional requests with 304
+    and are gzipped for clients that accept it.
+    """
+
+    def __init__(self, *args, slices=None, **kwargs):
+        self.slices = slices
+        super().__init__(*args, **kwargs)
+
+    def send_head(self):
+        path = unquote(urlsplit(self.path).path)
+        if path == f'/{AVAILABLE_DATA_NAME}':
+            self.range_length = None
+            return self.send_body(json.dumps(self.slices.available_data(self.directory), indent=4).encode(), 'application/json')
+        if os.path.isfile(self.translate_path(self.path)):
+            return super().send_head()
+        resolved = self.slices.resolve(path)
+        if resolved is None:
+            return super().send_head()
+
+        self.range_length = None
+        key, fingerprint = resolved
+        compress = 'gzip' in self.headers.get('Accept-Encoding', '')
+        etag = None
+        if fingerprint is not None:
+            etag = '"{}{}"'.format(hashlib.sha1(repr((key, fingerprint)).encode()).hexdigest()[:20], '-gzip' if compress else '')
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return None
+        try:
+            body = self.slices.get(key, fingerprint, compress)
+        except IndexError:
+            self.send_error(HTTPStatus.NOT_FOUND, "Slice out of range")
+            return None
+        return self.send_body(body, 'application/octet-stream', etag=etag, compressed=compress)
+
+    def send_body(self, body, content_type, etag=None, compressed=False):
+        """Send the headers of an in-memory response and return the body for copyfile."""
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        return io.BytesIO(body)
+
+def main(args):
+    if args.on_demand:
+        slices = SliceSource(args.input_data_dir, args.output_data_dir, cache_size=args.cache_size, models_dir=args.models_dir,
+                             model_num=args.model_num)
+        handler = partial(SliceRequestHandler, directory=args.directory, slices=slices)
+    else:
+        handler = partial(RangeRequestHandler, directory=args.directory)
+    with ThreadingHTTPServer((args.bind, args.port), handler) as server:
+        print(f"Serving {args.directory} at http://{args.bind}:{args.port}/main.html")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Host the web app with support for range requests.')
+    parser.add_argument('--directory', type=str, default='src', help='Directory of the web app.')
+    parser.add_argument('--bind', type=str, default='localhost', help='Address to bind to.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on.')
+    parser.add_argument('--on_demand', action='store_true', help='Render map tiles and attention heads that have not been formatted from the raw arrays.')
+    parser.add_argument('--input_data_dir', type=str, default='input_data', help='Directory for input data, with --on_demand.')
+    parser.add_argument('--output_data_dir', type=str, default='output_data', help='Directory for output data, with --on_demand.')
+    parser.add_argument('--cache_size', type=int, default=512, help='Number of rendered slices to keep in memory, with --on_demand.')
+    parser.add_argument('--models_dir', type=str, default='checkpoints', help='Directory of the indexed model naming the attention layers, with --on_demand.')
+    parser.add_argument('--model_num', type=int, help='Indexed model to name the layers after, by default any, with --on_demand.')
+
+    args = parser.parse_args()
+    main(args)
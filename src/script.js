@@ -3,14 +3,28 @@ document.addEventListener('DOMContentLoaded', async () => {
     const surfaceVarIdx = { "MSLP": 0, "U10": 1, "V10": 2, "T2M": 3 };
     const upperVarIdx = { "Z": 0, "Q": 1, "T": 2, "U": 3, "V": 4 };
 
-    // Intermediate layer names
-    const intermediateLayerNames = [
+    // Intermediate layer names, replaced by the graph index in layers.json when it exists
+    let intermediateLayerNames = [
         '/b1/Add_output_0', '/b1/Add_3_output_0', '/b1/Add_7_output_0', '/b1/Add_10_output_0',
         '/b1/Add_14_output_0', '/b1/Add_17_output_0', '/b1/Add_21_output_0', '/b1/Add_24_output_0',
         '/b1/Add_28_output_0', '/b1/Add_31_output_0', '/b1/Add_35_output_0', '/b1/Add_38_output_0',
         '/b1/Add_42_output_0', '/b1/Add_45_output_0', '/b1/Add_49_output_0', '/b1/Add_52_output_0',
     ];
 
+    // The same layers before the positional bias and after the softmax
+    let preBiasLayerNames = [
+        '/b1/MatMul_output_0', '/b1/MatMul_2_output_0', '/b1/MatMul_4_output_0', '/b1/MatMul_6_output_0',
+        '/b1/MatMul_8_output_0', '/b1/MatMul_10_output_0', '/b1/MatMul_12_output_0', '/b1/MatMul_14_output_0',
+        '/b1/MatMul_16_output_0', '/b1/MatMul_18_output_0', '/b1/MatMul_20_output_0', '/b1/MatMul_22_output_0',
+        '/b1/MatMul_24_output_0', '/b1/MatMul_26_output_0', '/b1/MatMul_28_output_0', '/b1/MatMul_30_output_0',
+    ];
+    let postSoftmaxLayerNames = [
+        '/b1/a11/Softmax_output_0', '/b1/a19/Softmax_output_0', '/b1/a29/Softmax_output_0', '/b1/a37/Softmax_output_0',
+        '/b1/a45/Softmax_output_0', '/b1/a53/Softmax_output_0', '/b1/a61/Softmax_output_0', '/b1/a68/Softmax_output_0',
+        '/b1/a77/Softmax_output_0', '/b1/a85/Softmax_output_0', '/b1/a93/Softmax_output_0', '/b1/a101/Softmax_output_0',
+        '/b1/a109/Softmax_output_0', '/b1/a117/Softmax_output_0', '/b1/a128/Softmax_output_0', '/b1/a136/Softmax_output_0',
+    ];
+
     // Current state variables
     let state = {
         currentSurfaceVariable: 'T2M',
@@ -21,9 +35,21 @@ document.addEventListener('DOMContentLoaded', async () => {
         currentDate: "",
         currentTime: "",
         currentLayer: "",
-        currentPressureLevel: 0
+        currentPressureLevel: 0,
+        currentStatsMetric: 'entropy'
     };
 
+    // Fetch the attention layers indexed from the model graph, if indexed
+    const indexedLayers = await fetch('layers.json', { cache: 'no-store' })
+        .then(response => response.ok ? response.json() : null)
+        .then(index => index ? index.layers : null)
+        .catch(() => null);
+    if (indexedLayers) {
+        intermediateLayerNames = indexedLayers.map(layer => layer.post_bias);
+        preBiasLayerNames = indexedLayers.map(layer => layer.pre_bias);
+        postSoftmaxLayerNames = indexedLayers.map(layer => layer.post_softmax);
+    }
+
     // Fetch available data
     const availableData = await fetch('available_data.json', { cache: 'no-store' }).then(response => response.json());
 
@@ -66,19 +92,40 @@ document.addEventListener('DOMContentLoaded', async () => {
     // Initial population of selects
     populateTimeAndLayerSelects();
 
+    // Get the index of a layer directory in whichever attention variant it belongs to
+    function getLayerIndex(layerName) {
+        for (const layerNames of [intermediateLayerNames, preBiasLayerNames, postSoftmaxLayerNames]) {
+            const layerIndex = layerNames.findIndex(name => name.replace(/\//g, '_') === layerName);
+            if (layerIndex !== -1) {
+                return layerIndex;
+            }
+        }
+        return -1;
+    }
+
     // Get layer configuration
     function getLayerConfig(layerName) {
-        const modifiedLayerName = layerName.replace(/^_/, '/').replace('_', '/');
-        const layerIndex = intermediateLayerNames.indexOf(modifiedLayerName);
+        const layerIndex = getLayerIndex(layerName);
+        if (indexedLayers && indexedLayers[layerIndex]) {
+            const layer = indexedLayers[layerIndex];
+            return { numHeads: layer.num_heads, configName: layer.config_name, chunkSize: layer.chunk_size,
+                     latWindows: layer.lat_windows, shifted: layer.shifted };
+        }
+        const shifted = layerIndex % 2 !== 0;
         return (layerIndex < 2 || layerIndex >= intermediateLayerNames.length - 2) ?
-            { numHeads: 6, configName: 'config_24x48', chunkSize: [24, 48] } :
-            { numHeads: 12, configName: 'config_48x96', chunkSize: [48, 96] };
+            { numHeads: 6, configName: 'config_24x48', chunkSize: [24, 48], latWindows: 31, shifted } :
+            { numHeads: 12, configName: 'config_48x96', chunkSize: [48, 96], latWindows: 16, shifted };
     }
 
     // Load binary data
     async function loadBinaryData(url, shape, dtype = 'float32') {
         const response = await fetch(url);
         const arrayBuffer = await response.arrayBuffer();
+        return decodeBinaryData(arrayBuffer, shape, dtype);
+    }
+
+    // Decode binary data into a tensor
+    function decodeBinaryData(arrayBuffer, shape, dtype = 'float32') {
         const typedArray = new Float32Array(arrayBuffer);
         if (typedArray.length !== shape.reduce((a, b) => a * b)) {
             throw new Error(`Mismatch in data size: expected ${shape.reduce((a, b) => a * b)} but got ${typedArray.length}`);
@@ -86,10 +133,109 @@ document.addEventListener('DOMContentLoaded', async () => {
         return tf.tensor(typedArray, shape, dtype);
     }
 
+    // Decode IEEE 754 half precision values
+    function decodeFloat16(uint16Array) {
+        const values = new Float32Array(uint16Array.length);
+        for (let i = 0; i < uint16Array.length; i++) {
+            const bits = uint16Array[i];
+            const sign = bits & 0x8000 ? -1 : 1;
+            const exponent = (bits >> 10) & 0x1f;
+            const fraction = bits & 0x3ff;
+            if (exponent === 0) {
+                values[i] = sign * Math.pow(2, -14) * (fraction / 1024);
+            } else if (exponent === 0x1f) {
+                values[i] = fraction ? NaN : sign * Infinity;
+            } else {
+                values[i] = sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+            }
+        }
+        return values;
+    }
+
+    // Expand a sparse attention record into a dense tensor, with zeros for the keys that were not kept
+    function decodeSparseAttentionRecord(arrayBuffer, index) {
+        const [, , , rows, cols] = index.shape;
+        const counts = new Uint8Array(arrayBuffer, 0, rows);
+        const numKept = counts.reduce((a, b) => a + b, 0);
+        const valueBytes = index.dtype === 'float16' ? 2 : 4;
+        const values = index.dtype === 'float16'
+            ? decodeFloat16(new Uint16Array(arrayBuffer, rows, numKept))
+            : new Float32Array(arrayBuffer, rows, numKept);
+        const keys = new Uint8Array(arrayBuffer, rows + numKept * valueBytes, numKept);
+        const dense = new Float32Array(rows * cols);
+        let k = 0;
+        for (let row = 0; row < rows; row++) {
+            for (let end = k + counts[row]; k < end; k++) {
+                dense[row * cols + keys[k]] = values[k];
+            }
+        }
+        return decodeBinaryData(dense.buffer, [rows, cols]);
+    }
+
+    // Decode a packed attention record in the storage type given by its index
+    function decodeAttentionRecord(arrayBuffer, index) {
+        if (index.encoding === 'sparse') {
+            return decodeSparseAttentionRecord(arrayBuffer, index);
+        }
+        const [, , , rows, cols] = index.shape;
+        const headerBytes = index.header_bytes || 0;
+        const payload = arrayBuffer.slice(headerBytes);
+        let values;
+        switch (index.dtype) {
+            case 'float16':
+                values = decodeFloat16(new Uint16Array(payload));
+                break;
+            case 'uint8':
+            case 'int8': {
+                const [scale, offset] = new Float32Array(arrayBuffer.slice(0, headerBytes));
+                const quantized = index.dtype === 'uint8' ? new Uint8Array(payload) : new Int8Array(payload);
+                values = Float32Array.from(quantized, value => value * scale + offset);
+                break;
+            }
+            default:
+                return decodeBinaryData(payload, [rows, cols]);
+        }
+        return decodeBinaryData(values.buffer, [rows, cols]);
+    }
+
+    // Load a byte range of a file, slicing the full response if the server ignores the range
+    async function loadBinaryRange(url, start, length) {
+        const response = await fetch(url, { headers: { 'Range': `bytes=${start}-${start + length - 1}` } });
+        const arrayBuffer = await response.arrayBuffer();
+        return response.status === 206 ? arrayBuffer : arrayBuffer.slice(start, start + length);
+    }
+
+    // Load the index of a packed attention layer, or null if the layer is stored as one file per head
+    const attentionIndexCache = {};
+    function loadAttentionIndex(attentionUrl) {
+        if (!(attentionUrl in attentionIndexCache)) {
+            attentionIndexCache[attentionUrl] = fetch(`${attentionUrl}/index.json`, { cache: 'no-store' })
+                .then(response => response.ok ? response.json() : null)
+                .catch(() => null);
+        }
+        return attentionIndexCache[attentionUrl];
+    }
+
+    // Load the per-window and head statistics of a layer, or null if the layer has none
+    const attentionStatsCache = {};
+    function loadAttentionStats(layerUrl) {
+        if (!(layerUrl in attentionStatsCache)) {
+            attentionStatsCache[layerUrl] = fetch(`${layerUrl}/stats.json`, { cache: 'no-store' })
+                .then(response => response.ok ? response.json() : null)
+                .then(async index => {
+                    if (!index) {
+                        return null;
+                    }
+                    const arrayBuffer = await fetch(`${layerUrl}/${index.file}`).then(response => response.arrayBuffer());
+                    return { ...index, values: new Float32Array(arrayBuffer) };
+                })
+                .catch(() => null);
+        }
+        return attentionStatsCache[layerUrl];
+    }
+
     async function loadMapChunk(latIndex, lonIndex, pressureLevel) {
-        const { configName, chunkSize } = getLayerConfig(state.currentLayer);
-        const layerIndex = intermediateLayerNames.indexOf(state.currentLayer.replace(/^_/, '/').replace('_', '/'));
-        const isOddLayer = layerIndex % 2 !== 0;
+        const { configName, chunkSize, shifted: isOddLayer } = getLayerConfig(state.currentLayer);
         const configSuffix = isOddLayer ? '_shifted' : '';
         let tensors = [];
 
@@ -128,27 +274,48 @@ document.addEventListener('DOMContentLoaded', async () => {
         if (head >= numHeads) {
             throw new Error(`Invalid head index: ${head} for layer ${state.currentLayer}`);
         }
-        const url = `bin/${state.currentDate}/${state.currentTime}/${state.currentLayer}/attention/attention_${lon}_${latPl}_${head}.bin`;
-        return loadBinaryData(url, [144, 144]);
+        const attentionUrl = `bin/${state.currentDate}/${state.currentTime}/${state.currentLayer}/attention`;
+        const index = await loadAttentionIndex(attentionUrl);
+        if (index) {
+            const [, numLatPl, numHeadsStored, rows, cols] = index.shape;
+            const record = (lon * numLatPl + latPl) * numHeadsStored + Number(head);
+            let start, recordBytes;
+            if (index.record_offsets) {
+                // Sparse records vary in size
+                start = index.offset + index.record_offsets[record];
+                recordBytes = index.record_offsets[record + 1] - index.record_offsets[record];
+            } else {
+                recordBytes = index.record_bytes || rows * cols * Float32Array.BYTES_PER_ELEMENT;
+                start = index.offset + record * recordBytes;
+            }
+            const arrayBuffer = await loadBinaryRange(`${attentionUrl}/${index.file}`, start, recordBytes);
+            return decodeAttentionRecord(arrayBuffer, index);
+        }
+        return loadBinaryData(`${attentionUrl}/attention_${lon}_${latPl}_${head}.bin`, [144, 144]);
     }
 
     // Initialize visualizations
     async function initializeVisualizations() {
         try {
             const mapDataTensors = await loadMapChunk(state.currentLatIndex, state.currentLonIndex, state.currentPressureLevel);
-            const latPlIndex = state.currentLatIndex + state.currentPressureLevel * (getLayerConfig(state.currentLayer).chunkSize[0] === 24 ? 31 : 16);
+            const latPlIndex = state.currentLatIndex + state.currentPressureLevel * getLayerConfig(state.currentLayer).latWindows;
             const attentionData = await loadAttentionChunk(state.currentLonIndex, latPlIndex, state.currentAttentionHead);
+            const stats = await loadAttentionStats(`bin/${state.currentDate}/${state.currentTime}/${state.currentLayer}`);
 
             const mapDataArray = mapDataTensors.map(tensor => tensor.arraySync());
             const attentionDataArray = attentionData.arraySync();
 
             clearContainer("#map-container");
             clearContainer("#attention-container");
+            clearContainer("#stats-container");
 
             mapDataArray.forEach((data, index) => {
                 initMap(data.flat(), mapDataTensors[index].shape, index);
             });
             initAttentionPattern(attentionDataArray, mapDataArray);
+            if (stats) {
+                initStatsHeatmap(stats, latPlIndex);
+            }
         } catch (error) {
             console.error('Failed to initialize visualizations:', error);
         }
@@ -209,6 +376,50 @@ document.addEventListener('DOMContentLoaded', async () => {
             });
     }
 
+    // Initialize a heatmap of one statistic of the current head over every window of the layer, click a window to show it
+    function initStatsHeatmap(stats, latPlIndex) {
+        const [numLon, numLatPl, numHeads, numMetrics] = stats.shape;
+        const metricIndex = stats.metrics.indexOf(state.currentStatsMetric);
+        const head = Number(state.currentAttentionHead);
+        const numLat = getLayerConfig(state.currentLayer).latWindows;
+        const cells = [];
+        for (let latPl = 0; latPl < numLatPl; latPl++) {
+            for (let lon = 0; lon < numLon; lon++) {
+                const value = stats.values[((lon * numLatPl + latPl) * numHeads + head) * numMetrics + metricIndex];
+                cells.push({ lon, latPl, value });
+            }
+        }
+
+        const svg = d3.select("#stats-container").append("svg")
+            .attr("viewBox", `0 0 ${numLon * 15} ${numLatPl * 15}`)
+            .attr("preserveAspectRatio", "xMidYMid meet")
+            .classed("svg-content-responsive", true);
+
+        const colorScale = d3.scaleSequential(d3.interpolateViridis).domain(d3.extent(cells, d => d.value));
+
+        svg.selectAll("rect")
+            .data(cells)
+            .enter().append("rect")
+            .attr("x", d => d.lon * 15)
+            .attr("y", d => d.latPl * 15)
+            .attr("width", 15)
+            .attr("height", 15)
+            .attr("fill", d => colorScale(d.value))
+            .attr("stroke", d => d.lon === state.currentLonIndex && d.latPl === latPlIndex ? "red" : null)
+            .attr("stroke-width", 2)
+            .on("click", (event, d) => {
+                state.currentLonIndex = d.lon;
+                state.currentLatIndex = d.latPl % numLat;
+                state.currentPressureLevel = Math.floor(d.latPl / numLat);
+                document.getElementById('longitude').value = state.currentLonIndex;
+                document.getElementById('latitude').value = state.currentLatIndex;
+                document.getElementById('pressure_level').value = state.currentPressureLevel;
+                initializeVisualizations();
+            })
+            .append("title")
+            .text(d => `lon ${d.lon}, lat ${d.latPl % numLat}, pressure level ${Math.floor(d.latPl / numLat)}: ${d.value.toFixed(4)}`);
+    }
+
     // Highlight map cells
     function highlightMapCells(attentionIndex, mapData) {
         const { chunkSize } = getLayerConfig(state.currentLayer);
@@ -249,8 +460,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                 let inSourceBlock = false;
 
                 if (state.currentPressureLevel === 0) {
-                    const layerIndex = intermediateLayerNames.indexOf(state.currentLayer.replace(/^_/, '/').replace('_', '/'));
-                    const isOddLayer = layerIndex % 2 !== 0;
+                    const isOddLayer = getLayerConfig(state.currentLayer).shifted;
                     if (isOddLayer) {
                         const upperIndexOffset = (tar_pl === 0) ? 0 : 2;
                         const currentUpperIndex = Math.floor(cellLatIndex / blockHeight);
@@ -327,6 +537,7 @@ document.addEventListener('DOMContentLoaded', async () => {
             'latitude': (value) => { state.currentLatIndex = parseInt(value, 10); },
             'longitude': (value) => { state.currentLonIndex = parseInt(value, 10); },
             'pressure_level': (value) => { state.currentPressureLevel = parseInt(value, 10); },
+            'stats-metric': (value) => { state.currentStatsMetric = value; },
             'date-select': (value) => { state.currentDate = value; populateTimeAndLayerSelects(); },
             'time-select': (value) => { state.currentTime = value; populateTimeAndLayerSelects(); },
             'layer-select': (value) => { state.currentLayer = value; updateAttentionHeadOptions(); }